@@ -2,15 +2,50 @@ import os
 
 class DevelopmentConfig:
     INITIALIZE_FROM_ZERO = False
+    # Skip the (PMC, target) units recorded in the alignment journal by previous runs
+    # (False clears the journal and aligns everything again)
+    RESUME_ALIGNMENT = True
+    # Keep aligned EMBERS___ columns in overlay files (INTEGRATED_DATA_DIR/samples_overlay) merged with
+    # PMC*_samples_update.json on read, instead of copying every samples file to _samples_update_integrated.json
+    # (run `python main.py materialize` to write the merged files for tools that read them directly)
+    SAMPLES_OVERLAY = True
     
     # LLM setting
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
     MODEL_NAME = 'gpt-4-turbo'
     MAX_TOKENS = 100000
 
+    # Limits of the worker process running generated transform code
+    TRANSFORM_TIMEOUT = 600  # seconds per (target, PMC)
+    TRANSFORM_MEMORY_LIMIT = 2 * 1024**3  # 2GB on top of the worker's baseline (Python, numpy, pandas)
+    # Also ask the LLM for a pandas (columnar) variant of each transform, falling back to row-wise
+    TRANSFORM_VECTORIZED = False
+    # Reuse validated transform code across PMCs with the same target, reference keys, value types and
+    # instructions (the library is cleared when RESUME_ALIGNMENT is False)
+    TRANSFORM_LIBRARY = True
+    TRANSFORM_LIBRARY_MAX_ERROR_RATE = 0.05
+    TRANSFORM_LIBRARY_MAX_CANDIDATES = 5
+    # Use transform code already registered for a (PMC, target) with the same reference keys and
+    # instructions instead of generating it again (the registry is cleared when RESUME_ALIGNMENT is False)
+    REUSE_TRANSFORM_CODE = True
+
     DATA_DIR = '/Volumes/MDatahubDev/Total_result'
     INTEGRATED_DATA_DIR = '/Volumes/MDatahubDev/Total_result_integration/integrated'
     LOG_DIR = '/Volumes/MDatahubDev/Total_result/log'
     INSTRUCTIONS_FILE = './instructions.json'
 
+    # Geocoding of aligned geographic locations (additional_alignment_for_geoloc.py)
+    # Backends are tried in order; 'gazetteer' needs GeoNames countryInfo.txt (and admin1CodesASCII.txt) in GEONAMES_DIR
+    GEOCODING_BACKENDS = ['gazetteer', 'nominatim']
+    GEONAMES_DIR = None
+    GEOCODING_CACHE_FILE = './geo_loc_cache.jsonl'
+    NOMINATIM_USER_AGENT = 'my_agent'
+    NOMINATIM_DOMAIN = None  # e.g. 'localhost:8080' for a self-hosted server
+    GEOCODING_MAX_PER_SECOND = 1  # public Nominatim usage policy
+    GEOCODING_WORKERS = 1
+    # Country boundary polygons (GeoJSON, e.g. Natural Earth admin 0 countries) for offline
+    # resolution of coordinate values; None sends coordinates to the backends as well
+    COUNTRY_BOUNDARIES_FILE = None
+    COUNTRY_NAME_PROPERTY = 'ADMIN'
+
 Config = DevelopmentConfig
@@ -13,11 +13,25 @@ class FileManager():
         self.log_dir = config.LOG_DIR
         self.instructions_file = config.INSTRUCTIONS_FILE
         self.initialize_from_zero = config.INITIALIZE_FROM_ZERO
+        self.samples_overlay = config.SAMPLES_OVERLAY
+        self.overlay_dir = os.path.join(self.integration_dir, 'samples_overlay')
+        self.transform_code_registry = {}
+        # PMC -> targets registered for the PMC, so that exporting a PMC does not scan the whole registry
+        self.transform_code_targets = {}
     
-    def setup_samples_files(self):
-        if self.initialize_from_zero:
+    def setup_samples_files(self, skip_pmcs=set()):
+        if self.samples_overlay:
+            # Nothing is copied: aligned columns are kept in overlay files merged on read
+            os.makedirs(self.overlay_dir, exist_ok=True)
+            if self.initialize_from_zero:
+                for overlay_file in glob.glob(os.path.join(self.overlay_dir, 'PMC*.json')):
+                    if os.path.basename(overlay_file)[:-len('.json')] not in skip_pmcs:
+                        os.remove(overlay_file)
+        elif self.initialize_from_zero:
             for samples_file in glob.glob(os.path.join(self.data_dir, 'PMC*/PMC*_samples_update.json')):
                 pmc_number = samples_file.split('/')[-1].split('_')[0]
+                if pmc_number in skip_pmcs:
+                    continue
                 output_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
                 shutil.copy(samples_file, output_file)
         else:
@@ -47,19 +61,94 @@ class FileManager():
     
     def check_if_samples_json_exists(self, pmc_number):
         samples_json_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
+        if self.samples_overlay:
+            base_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update.json')
+            return os.path.exists(base_file) or os.path.exists(samples_json_file)
         return os.path.exists(samples_json_file)
     
     def load_samples_json(self, pmc_number):
         samples_json_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
+        if self.samples_overlay:
+            return self.load_samples_with_overlay(pmc_number)
         with open(samples_json_file, 'r') as f:
             samples_json = json.load(f)
         return samples_json
     
     def update_samples_json(self, pmc_number, samples_json):
         samples_json_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
+        if self.samples_overlay:
+            self.write_overlay(pmc_number, samples_json)
+            return
         with open(samples_json_file, 'w') as f:
             json.dump(samples_json, f, indent=4)
-    
+
+    def load_samples_with_overlay(self, pmc_number):
+        ###
+        # 元のsamplesファイルに、オーバーレイのEMBERS___列をサンプル番号ごとに重ねて返す
+        ###
+        overlay_file = os.path.join(self.overlay_dir, f'{pmc_number}.json')
+        base_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update.json')
+        legacy_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
+        if not os.path.exists(overlay_file) and \
+            not self.initialize_from_zero and \
+                os.path.exists(legacy_file):
+            # Integrated file of a run before overlays were used (it already holds its aligned columns)
+            base_file = legacy_file
+        with open(base_file, 'r') as f:
+            samples_json = json.load(f)
+        if os.path.exists(overlay_file):
+            with open(overlay_file, 'r') as f:
+                overlay = json.load(f)
+            out_of_range = []
+            for index, columns in overlay.items():
+                if int(index) >= len(samples_json):
+                    out_of_range.append(int(index))
+                    continue
+                samples_json[int(index)].update(columns)
+            if len(out_of_range) > 0:
+                # The samples file was replaced by a shorter one after the overlay was written
+                logging.error(f'{pmc_number}: overlay has sample indices beyond the {len(samples_json)} samples '
+                              f'of {base_file} ({sorted(out_of_range)[:10]}); ignored')
+        return samples_json
+
+    def write_overlay(self, pmc_number, samples_json):
+        # Only the EMBERS___ columns, keyed by sample index, written atomically
+        overlay = {}
+        for i, sample in enumerate(samples_json):
+            columns = {key: value for key, value in sample.items() if key.startswith('EMBERS___')}
+            if len(columns) > 0:
+                overlay[str(i)] = columns
+        overlay_file = os.path.join(self.overlay_dir, f'{pmc_number}.json')
+        with open(overlay_file + '.tmp', 'w') as f:
+            json.dump(overlay, f)
+        os.replace(overlay_file + '.tmp', overlay_file)
+
+    def materialize_samples_json(self, pmc_number, only_existing=False):
+        # Write the merged _samples_update_integrated.json for tools that read it directly
+        # (skipped if it is already newer than the overlay and the base samples file; with only_existing,
+        # also skipped if it was never written); returns whether it was written
+        overlay_file = os.path.join(self.overlay_dir, f'{pmc_number}.json')
+        base_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update.json')
+        samples_json_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_samples_update_integrated.json')
+        if not os.path.exists(samples_json_file):
+            if only_existing:
+                return False
+        elif not os.path.exists(overlay_file) or \
+            (os.path.getmtime(samples_json_file) > os.path.getmtime(overlay_file) and \
+                (not os.path.exists(base_file) or os.path.getmtime(samples_json_file) > os.path.getmtime(base_file))):
+            return False
+        samples_json = self.load_samples_with_overlay(pmc_number)
+        with open(samples_json_file + '.tmp', 'w') as f:
+            json.dump(samples_json, f, indent=4)
+        os.replace(samples_json_file + '.tmp', samples_json_file)
+        return True
+
+    def load_integration(self):
+        integration_file = os.path.join(self.integration_dir, 'integration.json')
+        with open(integration_file, 'r') as f:
+            integration = json.load(f)
+        return integration
+
     def write_integration(self, integration):
         output_file = os.path.join(self.integration_dir, 'integration.json')
         with open(output_file, 'w') as f:
@@ -70,15 +159,138 @@ class FileManager():
         with open(output_file, 'w') as f:
             json.dump(keyname_variations, f, indent=4)
 
-    def write_transform_code(self, key, pmc_number, transform_code_result):
+    def load_transform_code_registry(self):
+        ###
+        # (PMC, ターゲット) → 変換コードの登録簿を読み込む
+        # 追記型のJSONLで、同じキーは後の行が優先される。書き込み途中の最終行は無視する
+        ###
+        self.transform_code_registry = {}
+        self.transform_code_targets = {}
+        registry_file = os.path.join(self.integration_dir, 'transform_code_registry.jsonl')
+        if os.path.exists(registry_file):
+            corrupted = False
+            with open(registry_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        corrupted = True
+                        continue
+                    self.register_transform_code(record['Target'], record['PMC_ID'], record.get('Signature'), record['Result'])
+            if corrupted:
+                # Drop the partial line so that new records are not appended to it
+                self.compact_transform_code_registry()
+        return self.transform_code_registry
+
+    def get_transform_code(self, key, pmc_number, signature):
+        # Transform code already generated for (PMC, target) from the same reference keys and instructions, or None
+        entry = self.transform_code_registry.get((pmc_number, key))
+        if entry is None or entry['Signature'] != signature:
+            return None
+        return entry['Result']
+
+    def write_transform_code(self, key, pmc_number, signature, transform_code_result):
+        # Append one record; a single line write cannot corrupt the records before it
+        registry_file = os.path.join(self.integration_dir, 'transform_code_registry.jsonl')
+        with open(registry_file, 'a') as f:
+            f.write(json.dumps({'PMC_ID': pmc_number,
+                                'Target': key,
+                                'Signature': signature,
+                                'Result': transform_code_result}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.register_transform_code(key, pmc_number, signature, transform_code_result)
+
+    def register_transform_code(self, key, pmc_number, signature, transform_code_result):
+        # In-memory registry and PMC -> targets index (a later record of the same (PMC, target) replaces it)
+        if (pmc_number, key) not in self.transform_code_registry:
+            self.transform_code_targets.setdefault(pmc_number, []).append(key)
+        self.transform_code_registry[(pmc_number, key)] = {'Signature': signature,
+                                                           'Result': transform_code_result}
+
+    def export_transform_code(self, pmc_number):
+        # Write {pmc}_transform_code.json with all targets of the PMC at once (atomically)
+        content = {key: self.transform_code_registry[(pmc_number, key)]['Result']
+                   for key in self.transform_code_targets.get(pmc_number, [])}
+        if len(content) == 0:
+            return
         output_file = os.path.join(self.data_dir, f'{pmc_number}/{pmc_number}_transform_code.json')
-        if not os.path.exists(output_file):
-            out_content = {}
-            out_content[key] = transform_code_result
-            with open(output_file, 'w') as f:
-                json.dump(out_content, f, indent=4)
-        else:
-            previous_content = json.load(open(output_file, 'r'))
-            previous_content[key] = transform_code_result
-            with open(output_file, 'w') as f:
-                json.dump(previous_content, f, indent=4)
+        with open(output_file + '.tmp', 'w') as f:
+            json.dump(content, f, indent=4)
+        os.replace(output_file + '.tmp', output_file)
+
+    def compact_transform_code_registry(self):
+        # Rewrite the registry with only the latest record of each (PMC, target)
+        registry_file = os.path.join(self.integration_dir, 'transform_code_registry.jsonl')
+        with open(registry_file + '.tmp', 'w') as f:
+            for (pmc_number, key), entry in self.transform_code_registry.items():
+                f.write(json.dumps({'PMC_ID': pmc_number,
+                                    'Target': key,
+                                    'Signature': entry['Signature'],
+                                    'Result': entry['Result']}) + '\n')
+        os.replace(registry_file + '.tmp', registry_file)
+
+    def reset_transform_code_registry(self):
+        registry_file = os.path.join(self.integration_dir, 'transform_code_registry.jsonl')
+        if os.path.exists(registry_file):
+            os.remove(registry_file)
+        self.transform_code_registry = {}
+        self.transform_code_targets = {}
+
+    def write_transform_stats(self, transform_stats):
+        output_file = os.path.join(self.integration_dir, 'transform_stats.json')
+        with open(output_file, 'w') as f:
+            json.dump(transform_stats, f, indent=4)
+
+    def load_transform_library(self):
+        library_file = os.path.join(self.integration_dir, 'transform_library.json')
+        if not os.path.exists(library_file):
+            return {}
+        with open(library_file, 'r') as f:
+            return json.load(f)
+
+    def write_transform_library(self, transform_library):
+        library_file = os.path.join(self.integration_dir, 'transform_library.json')
+        with open(library_file + '.tmp', 'w') as f:
+            json.dump(transform_library, f, indent=4)
+        os.replace(library_file + '.tmp', library_file)
+
+    def reset_transform_library(self):
+        library_file = os.path.join(self.integration_dir, 'transform_library.json')
+        if os.path.exists(library_file):
+            os.remove(library_file)
+
+    def load_align_journal(self):
+        # (PMC, target) -> record of the units completed by previous alignment runs
+        journal = {}
+        journal_file = os.path.join(self.integration_dir, 'align_journal.jsonl')
+        if os.path.exists(journal_file):
+            corrupted = False
+            with open(journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        corrupted = True
+                        continue
+                    journal[(record['PMC_ID'], record['Target'])] = record
+            if corrupted:
+                # Drop the partially written last line so that new records are not appended to it
+                with open(journal_file + '.tmp', 'w') as f:
+                    for record in journal.values():
+                        f.write(json.dumps(record) + '\n')
+                os.replace(journal_file + '.tmp', journal_file)
+        return journal
+
+    def append_align_journal(self, records):
+        journal_file = os.path.join(self.integration_dir, 'align_journal.jsonl')
+        with open(journal_file, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset_align_journal(self):
+        journal_file = os.path.join(self.integration_dir, 'align_journal.jsonl')
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from reverse_geocoding import CountryIndex, resolve_coordinates
+
+# Values that carry no location information
+UNINFORMATIVE_LOCATIONS = ['not applicable', 'not collected', 'not provided', 'unknown', 'missing', 'restricted access']
+
+# Common country name variants not listed in the GeoNames country names
+# (also used for the names of country boundary datasets)
+COUNTRY_ALIASES = {'usa': 'United States',
+                   'us': 'United States',
+                   'u.s.a.': 'United States',
+                   'u.s.': 'United States',
+                   'united states of america': 'United States',
+                   'uk': 'United Kingdom',
+                   'u.k.': 'United Kingdom',
+                   'great britain': 'United Kingdom',
+                   'england': 'United Kingdom',
+                   'scotland': 'United Kingdom',
+                   'wales': 'United Kingdom',
+                   'northern ireland': 'United Kingdom',
+                   'korea': 'South Korea',
+                   'republic of korea': 'South Korea',
+                   'russian federation': 'Russia',
+                   "people's republic of china": 'China',
+                   'viet nam': 'Vietnam',
+                   'czech republic': 'Czechia',
+                   'united republic of tanzania': 'Tanzania',
+                   'republic of serbia': 'Serbia'}
+
+# Canadian province/territory postal abbreviations (GeoNames admin1 codes of Canada are numeric)
+CANADIAN_PROVINCES = ['ab', 'bc', 'mb', 'nb', 'nl', 'ns', 'nt', 'nu', 'on', 'pe', 'qc', 'sk', 'yt']
+
+# Version of the cache records; records written before the region abbreviation fix are re-checked
+GEOCACHE_VERSION = 2
+
+def normalize_location(location):
+    ###
+    # ジオコーディングの問い合わせ文字列を作る
+    # INSDC形式 'Country: region' は国名部分だけを使い、情報のない値はNoneにする
+    ###
+    if not isinstance(location, str):
+        return None
+    query = location.split(':')[0] if ':' in location else location
+    query = re.sub(r'\s+', ' ', query).strip(' ,;.')
+    if query == '' or \
+        any(word in query.lower() for word in UNINFORMATIVE_LOCATIONS):
+        return None
+    return query
+
+def cache_key(query):
+    return query.lower()
+
+class RateLimiter():
+    ###
+    # スレッド間で共有するリクエスト間隔の制限
+    ###
+    def __init__(self, max_per_second):
+        self.min_interval = 1.0 / float(max_per_second)
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.perf_counter()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class NominatimBackend():
+    ###
+    # Nominatimによるジオコーディング
+    # 順方向の結果のaddressdetailsから国名を取り、逆ジオコーディングは行わない
+    ###
+    def __init__(self, user_agent='embers', max_per_second=1, domain=None):
+        from geopy.geocoders import Nominatim
+        if domain is None:
+            self.geolocator = Nominatim(user_agent=user_agent)
+        else:
+            # Self-hosted Nominatim server (allows a higher request rate)
+            self.geolocator = Nominatim(user_agent=user_agent, domain=domain, scheme='http')
+        self.rate_limiter = RateLimiter(max_per_second)
+
+    def geocode(self, query):
+        # Timeouts and service errors are raised, so that the query is not cached as unresolved
+        self.rate_limiter.wait()
+        geo_location = self.geolocator.geocode(query, language='en', addressdetails=True)
+        if geo_location and 'country' in geo_location.raw.get('address', {}):
+            return geo_location.raw['address']['country']
+        return None
+
+class GazetteerBackend():
+    ###
+    # GeoNamesのダンプ(countryInfo.txt, admin1CodesASCII.txt)を使ったオフラインのジオコーディング
+    # 国名・国コード・第1階層の行政区名を国名に引く
+    # 2文字の国コードは問い合わせ全体に一致したときだけ使う('Boston, MA'のMAはモロッコではなく州)
+    ###
+    def __init__(self, geonames_dir):
+        self.names = {}
+        # Two-letter US state and Canadian province abbreviations, e.g. 'Boston, MA'
+        self.region_codes = {}
+        country_names = {}
+        with open(os.path.join(geonames_dir, 'countryInfo.txt'), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#') or line.strip() == '':
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                iso, iso3, country = fields[0], fields[1], fields[4]
+                country_names[iso] = country
+                for name in [iso, iso3, country]:
+                    self.names[self.normalize(name)] = country
+        for alias, country in COUNTRY_ALIASES.items():
+            self.names[self.normalize(alias)] = country
+
+        admin1_file = os.path.join(geonames_dir, 'admin1CodesASCII.txt')
+        if os.path.exists(admin1_file):
+            admin1_names = {}
+            with open(admin1_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) < 3 or fields[0].split('.')[0] not in country_names:
+                        continue
+                    iso, admin1_code = fields[0].split('.', 1)
+                    country = country_names[iso]
+                    for name in fields[1:3]:
+                        admin1_names.setdefault(self.normalize(name), set()).add(country)
+                    if iso == 'US' and re.fullmatch(r'[A-Z]{2}', admin1_code):
+                        self.region_codes[admin1_code.lower()] = country
+            # Region names shared by several countries are ambiguous; country names take precedence
+            for name, countries in admin1_names.items():
+                if len(countries) == 1 and name not in self.names:
+                    self.names[name] = countries.pop()
+        if 'CA' in country_names:
+            for code in CANADIAN_PROVINCES:
+                self.region_codes[code] = country_names['CA']
+        logging.info(f'Loaded {len(self.names)} gazetteer names')
+
+    def normalize(self, name):
+        return re.sub(r'\s+', ' ', name).strip().lower()
+
+    def geocode(self, query):
+        name = self.normalize(query)
+        if name in self.names:
+            return self.names[name]
+        # e.g. 'Brookings, SD, USA': try the comma separated parts from the last one
+        for part in reversed(name.split(',')):
+            part = part.strip()
+            if len(part) == 2:
+                # A two-letter part is a state/province abbreviation, not a country code
+                if part in self.region_codes:
+                    return self.region_codes[part]
+                continue
+            if part in self.names:
+                return self.names[part]
+        return None
+
+class ChainBackend():
+    # Try the backends in order (e.g. the offline gazetteer first, then Nominatim)
+    def __init__(self, backends):
+        self.backends = backends
+
+    def geocode(self, query):
+        for backend in self.backends:
+            country = backend.geocode(query)
+            if country is not None:
+                return country
+        return None
+
+class GeoCache():
+    ###
+    # 問い合わせ文字列 → 国名の永続キャッシュ
+    # 追記型のJSONLで、解決するたびに書き込むので中断しても結果は失われない
+    ###
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.cache = {}
+        self.lock = threading.Lock()
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written last line
+                        continue
+                    if record.get('Version', 1) < GEOCACHE_VERSION and \
+                        re.search(r',\s*[a-z]{2}(,|$)', record['Query']):
+                        # Earlier gazetteer versions read 'City, ST' as a country code; look it up again
+                        continue
+                    self.cache[record['Query']] = record['Country']
+
+    def __contains__(self, query):
+        return cache_key(query) in self.cache
+
+    def get(self, query):
+        return self.cache.get(cache_key(query))
+
+    def add(self, query, country):
+        with self.lock:
+            self.cache[cache_key(query)] = country
+            with open(self.cache_file, 'a') as f:
+                f.write(json.dumps({'Query': cache_key(query),
+                                    'Country': country,
+                                    'Version': GEOCACHE_VERSION}) + '\n')
+
+def build_backend(config):
+    backends = []
+    for name in config.GEOCODING_BACKENDS:
+        if name == 'gazetteer':
+            if config.GEONAMES_DIR is None:
+                logging.info('GEONAMES_DIR is not set; skipping the gazetteer backend')
+                continue
+            backends.append(GazetteerBackend(config.GEONAMES_DIR))
+        elif name == 'nominatim':
+            backends.append(NominatimBackend(user_agent=config.NOMINATIM_USER_AGENT,
+                                             max_per_second=config.GEOCODING_MAX_PER_SECOND,
+                                             domain=config.NOMINATIM_DOMAIN))
+        else:
+            raise ValueError(f'Unknown geocoding backend: {name}')
+    return ChainBackend(backends)
+
+def canonical_country(country):
+    # Map country name variants (e.g. of boundary datasets) to the names used by the other backends
+    if country is None:
+        return None
+    return COUNTRY_ALIASES.get(country.lower(), country)
+
+def build_country_index(config):
+    if config.COUNTRY_BOUNDARIES_FILE is None:
+        return None
+    return CountryIndex(config.COUNTRY_BOUNDARIES_FILE,
+                        name_property=config.COUNTRY_NAME_PROPERTY)
+
+def geocode_locations(locations, backend, cache, n_workers=1, country_index=None):
+    """
+    Resolve the country of each location string.
+
+    Parameters:
+        locations (iterable): The raw location values.
+        backend: An object with a geocode(query) method returning a country name or None.
+        cache (GeoCache): The persistent cache; new results are appended as they are resolved.
+        n_workers (int): The number of concurrent lookups (the backend enforces its own rate limit).
+        country_index (CountryIndex): If given, coordinate pairs are resolved offline with it
+            and never sent to the backend.
+
+    Returns:
+        dict: location -> country (None if not resolved).
+    """
+    locations = list(locations)
+    resolved = {}
+    if country_index is not None:
+        resolved = {location: canonical_country(country)
+                    for location, country in resolve_coordinates(locations, country_index).items()}
+        logging.info(f'Coordinates resolved offline: {len(resolved)}')
+        locations = [location for location in locations if location not in resolved]
+
+    queries = {location: normalize_location(location) for location in locations}
+    pending = sorted(set(q for q in queries.values() if q is not None and q not in cache), key=cache_key)
+    # Different spellings normalizing to the same cache key are looked up once
+    pending = list({cache_key(q): q for q in pending}.values())
+    logging.info(f'Unique locations: {len(queries)}, queries: {len(set(q for q in queries.values() if q is not None))}, '
+                 f'not cached: {len(pending)}')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(backend.geocode, query): query for query in pending}
+        for i, future in enumerate(as_completed(futures)):
+            query = futures[future]
+            try:
+                country = future.result()
+            except Exception as e:
+                logging.info(f'\t{i+1}/{len(pending)} Lookup of "{query}" failed ({e}); will retry on the next run')
+                continue
+            cache.add(query, country)
+            if country:
+                logging.info(f'\t{i+1}/{len(pending)} {query} => {country}')
+            else:
+                logging.info(f'\t{i+1}/{len(pending)} Failed to get country for "{query}"')
+
+    resolved.update({location: (cache.get(query) if query is not None else None)
+                     for location, query in queries.items()})
+    return resolved
@@ -50,7 +50,8 @@ class LLM():
         return result_json
     
     def generate_transformation_code(self,
-                                     input_conditions=[]):
+                                     input_conditions=[],
+                                     vectorized=False):
 
         system_setting_prompt = '''
 Given the following inputs:
@@ -73,6 +74,14 @@ Include error handling and edge case considerations in the generated code. Provi
 Please ensure that the generated Python code only defines the 'transform_data' function and does not include any example usage or test cases. The 'transform_data' function should be directly callable with the 'input' variable after executing the script with exec(), and it should return only the transformed value.
 
 If the generated code uses any functions from non-standard Python packages, such as numpy.isnan or math.isnan, please include the necessary import statements at the beginning of the script.
+'''
+        if vectorized:
+            system_setting_prompt += '''
+In addition, if the transformation can be expressed with pandas column operations, add the following field to the JSON object:
+
+"Vectorized_code": "A Python script that can be directly executed using exec(). The script should import pandas and define a function named 'transform_data_vectorized' that takes a dict mapping each reference key to a pandas Series of its values (one element per sample, None where the key is missing) and returns a pandas Series of the transformed values with the same length and order. It must produce the same values as 'transform_data'."
+
+If a vectorized implementation is not practical, set "Vectorized_code" to null.
 '''
 
         user_input = f'''
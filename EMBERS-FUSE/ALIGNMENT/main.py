@@ -1,4 +1,5 @@
 import os
+import time
 import numpy as np
 import json
 import logging
@@ -7,35 +8,63 @@ from config import Config
 from llm import LLM
 import datetime
 from filemanager import FileManager
+from transform import TransformRunner, transform_signature, registry_signature
 
 class Aligner():
     def __init__(self, llm, filemanager):
         self.llm = llm
         self.filemanager = filemanager
         self.special_instructions = self.filemanager.load_instructions()
+        # Label -> PMC -> keys grouping, built on first use by load_key_groups
+        self.integrated_labels = None
+        self.key_groups = None
+        self.transform_runner = TransformRunner(timeout=Config.TRANSFORM_TIMEOUT,
+                                                memory_limit=Config.TRANSFORM_MEMORY_LIMIT)
+        # Completed (PMC, target) units of previous runs
+        if Config.RESUME_ALIGNMENT:
+            self.journal = self.filemanager.load_align_journal()
+        else:
+            # Transform code of earlier runs may be outdated (re-clustered keys, changed instructions)
+            self.filemanager.reset_align_journal()
+            self.filemanager.reset_transform_code_registry()
+            self.filemanager.reset_transform_library()
+            self.journal = {}
         logging.info('Setting up samples files...')
-        self.filemanager.setup_samples_files()
+        # Samples files with journaled units already hold aligned values and are not reset
+        self.filemanager.setup_samples_files(skip_pmcs=set(pmc_number for pmc_number, _ in self.journal.keys()))
         logging.info('Samples files are set up.')
     
-    def clustering_result_extraction(self):
-        logging.info('Loading integrated labels...')
-        integrated_labels = self.filemanager.load_integrated_labals()
+    def load_key_groups(self):
+        ###
+        # 統合ラベル → PMC → キー名・キー説明のグループを1回の走査で作成し、以降は使い回す
+        ###
+        if self.key_groups is not None:
+            return
+        self.integrated_labels = self.filemanager.load_integrated_labals()
         keys_labels = self.filemanager.load_keys_labels()
         keys_texts = self.filemanager.load_keys_texts()
 
+        self.key_groups = {}
+        for label, key_text in zip(keys_labels, keys_texts):
+            pmc_group = self.key_groups.setdefault(label, {}).setdefault(key_text['PMC_ID'], {'Keys':[], 'Keys_Info':[]})
+            pmc_group['Keys'].append(key_text['Key'])
+            pmc_group['Keys_Info'].append(key_text['Description'])
+
+    def clustering_result_extraction(self):
+        logging.info('Loading integrated labels...')
+        self.load_key_groups()
+
         self.integration = {}
-        for integrated_label in integrated_labels:
+        for integrated_label in self.integrated_labels:
             label = integrated_label['Label']
             description = integrated_label['Description']
             self.integration[label] = {}
             self.integration[label]['Description'] = description
             self.integration[label]['Original_keys'] = []
-            keys_indices = np.where(np.array(keys_labels) == label)[0]
-            pmc_numbers = list(set([keys_texts[n]['PMC_ID'] for n in keys_indices]))
-            for pmc_id in pmc_numbers:
+            for pmc_id, pmc_group in self.key_groups.get(label, {}).items():
                 pmc_info = {'PMC_ID':pmc_id}
-                pmc_info['Keys'] = [keys_texts[n]['Key'] for n in keys_indices if keys_texts[n]['PMC_ID'] == pmc_id]
-                pmc_info['Keys_Info'] = [keys_texts[n]['Description'] for n in keys_indices if keys_texts[n]['PMC_ID'] == pmc_id]
+                pmc_info['Keys'] = pmc_group['Keys']
+                pmc_info['Keys_Info'] = pmc_group['Keys_Info']
                 self.integration[label]['Original_keys'].append(pmc_info)
         
         self.filemanager.write_integration(self.integration)
@@ -43,111 +72,251 @@ class Aligner():
     
     def keyname_variations(self):
         logging.info('Extracting key names variations...')
-        integrated_labels = self.filemanager.load_integrated_labals()
-        keys_labels = self.filemanager.load_keys_labels()
-        keys_texts = self.filemanager.load_keys_texts()
+        self.load_key_groups()
 
         key_name_variations = {}
-        for integrated_label in integrated_labels:
+        for integrated_label in self.integrated_labels:
             integrated_label_description = integrated_label['Description']
             integrated_label = integrated_label['Label']
 
-            keys_indices = np.where(np.array(keys_labels) == integrated_label)[0]
-            key_names = []
-            for key_index in keys_indices:
-                key_names.append(keys_texts[key_index]['Key'])
+            key_names = set()
+            for pmc_group in self.key_groups.get(integrated_label, {}).values():
+                key_names.update(pmc_group['Keys'])
             key_name_variations[integrated_label] = {}
-            key_name_variations[integrated_label]['Key_names'] = list(set(key_names))
+            key_name_variations[integrated_label]['Key_names'] = list(key_names)
             key_name_variations[integrated_label]['Description'] = integrated_label_description
 
         self.filemanager.write_keyname_variations(key_name_variations)
         logging.info('Extracting key names variations...Done.')
     
-    def align_keys(self):
-        logging.info('Aligning keys...')
+    def record_transform_errors(self, target, pmc_number, n_samples, errors, info):
+        self.transform_stats.setdefault(target, {})[pmc_number] = {
+            'Samples': n_samples,
+            'Errors': len(errors),
+            'Error_rate': len(errors) / n_samples if n_samples > 0 else 0.0,
+            'Error_examples': [message for _, message in errors[:5]],
+            **info,
+        }
+        logging.info(f'\t\tTransformed {n_samples} samples ({info.get("Distinct_inputs")} distinct inputs, '
+                     f'{info["Mode"]})')
+        if 'Vectorized_error' in info:
+            logging.info(f'\t\tVectorized transform failed, used row-wise transform: {info["Vectorized_error"]}')
+        if len(errors) > 0:
+            logging.info(f'\t\t{len(errors)}/{n_samples} samples failed: {errors[0][1]}')
 
-        for i, target in enumerate(self.integration.keys()):
-            logging.info(f'Aligning target: {target}')
-
-            for original_key in self.integration[target]['Original_keys']:
-                logging.info('\t'+str(original_key))
+    def reuse_transform(self, signature, samples_key_values):
+        # A library transform with the same signature that converts the sampled values without errors
+        for candidate in self.transform_library.get(signature, []):
+            outputs, errors, _ = self.transform_runner.run(candidate['Python_code'], samples_key_values)
+            if len(errors) == 0 and \
+                any(output is not None for output in outputs):
+                return candidate
+        return None
 
+    def add_to_library(self, signature, result, pmc_number):
+        candidates = self.transform_library.setdefault(signature, [])
+        if len(candidates) < Config.TRANSFORM_LIBRARY_MAX_CANDIDATES:
+            candidates.append({**result, 'Source_PMC': pmc_number})
+            self.transform_library_updated = True
 
-                pmc_number = original_key['PMC_ID']
-                keys = original_key['Keys']
-                keys_info = original_key['Keys_Info']
+    def unit_signature(self, target, keys):
+        # Signature of a (PMC, target) unit: its reference keys and the instructions of the target
+        instructions = self.special_instructions[target]['Instructions'] if target in self.special_instructions else None
+        return registry_signature(target, keys, instructions)
 
-                samples = self.filemanager.load_samples_json(pmc_number)
+    def group_targets_by_pmc(self):
+        # PMC_ID -> list of (target, original keys of the PMC mapped to the target)
+        targets_by_pmc = {}
+        for target in self.integration.keys():
+            for original_key in self.integration[target]['Original_keys']:
+                targets_by_pmc.setdefault(original_key['PMC_ID'], []).append((target, original_key))
+        return targets_by_pmc
 
-                if target in self.special_instructions.keys():
-                    instructions = self.special_instructions[target]['Instructions']
+    def align_target(self, target, pmc_number, keys, keys_info, samples):
+        ###
+        # 1つのターゲットについて、samplesの各サンプルにEMBERS___{target}を書き込む (samplesを直接更新する)
+        ###
+        if target in self.special_instructions.keys():
+            instructions = self.special_instructions[target]['Instructions']
 
-                    # Randomly sample 10 elements.
-                    random_indices = np.random.choice(len(samples), min(10, len(samples)), replace=False)
-                    samples_key_values = []
-                    for i in random_indices:
-                        samples_key_values.append({key:samples[i].get(key) for key in keys})
+            # Randomly sample 10 elements.
+            random_indices = np.random.choice(len(samples), min(10, len(samples)), replace=False)
+            samples_key_values = []
+            for i in random_indices:
+                samples_key_values.append({key:samples[i].get(key) for key in keys})
 
-                    input_conditions = {}
-                    input_conditions['reference_keys'] = keys
-                    input_conditions['target_key'] = target
-                    input_conditions['reference_key_descriptions'] = keys_info
-                    input_conditions['target_key_description'] = instructions
-                    input_conditions['sample_values'] = samples_key_values
+            input_conditions = {}
+            input_conditions['reference_keys'] = keys
+            input_conditions['target_key'] = target
+            input_conditions['reference_key_descriptions'] = keys_info
+            input_conditions['target_key_description'] = instructions
+            input_conditions['sample_values'] = samples_key_values
 
+            signature = transform_signature(target, keys, samples_key_values, instructions)
+            code_signature = self.unit_signature(target, keys)
+            # Transform code generated for this (PMC, target) by an earlier, interrupted run
+            result = self.filemanager.get_transform_code(target, pmc_number, code_signature) \
+                if Config.REUSE_TRANSFORM_CODE else None
+            if result is not None:
+                logging.info('\t\tUsing the registered transform code')
+                reused = True
+            else:
+                result = self.reuse_transform(signature, samples_key_values) if Config.TRANSFORM_LIBRARY else None
+                if result is None:
                     try:
-                        result = self.llm.generate_transformation_code(input_conditions=input_conditions)
+                        result = self.llm.generate_transformation_code(input_conditions=input_conditions,
+                                                                       vectorized=Config.TRANSFORM_VECTORIZED)
                         result = json.loads(result)
                     except Exception as e:
                         # Retry
                         logging.info(e)
-                        result = self.llm.generate_transformation_code(input_conditions=input_conditions)
+                        result = self.llm.generate_transformation_code(input_conditions=input_conditions,
+                                                                       vectorized=Config.TRANSFORM_VECTORIZED)
                         result = json.loads(result)
-                    
-                    self.filemanager.write_transform_code(target, pmc_number, result)
-
-                    transform_code = result['Python_code']
-
-                    if 'Conversion_possible' in result.keys() and result['Conversion_possible'] == 'yes':
-                        for i in range(len(samples)):
-
-                            current_input = {}
-                            for key in keys:
-                                if key in samples[i].keys():
-                                    current_input[key] = samples[i][key]
-                                else:
-                                    current_input[key] = None
-
-                            local_vars = {'input': current_input}
-
-                            samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
-                            for key in keys:
-                                current_element = {'key':key, 'value':samples[i].get(key)}
-                                samples[i][f'EMBERS___{target}']['Original'].append(current_element)
-
-                            try:
-                                exec(transform_code, local_vars)
-                                transformed_value = local_vars['transform_data'](current_input)
-                                samples[i][f'EMBERS___{target}']['Aligned'] = transformed_value
-                            except Exception as e:
-                                logging.info(e)
-                    else:
-                        # no conversion possible
-                        for i in range(len(samples)):
-                            samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
-                            for key in keys:
-                                current_element = {'key':key, 'value':samples[i].get(key)}
-                                samples[i][f'EMBERS___{target}']['Original'].append(current_element)
+                    self.n_llm_calls += 1
+                    reused = False
                 else:
-                    # no special instructions
-                    for i in range(len(samples)):
-                        samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
-                        for key in keys:
-                            current_element = {'key':key, 'value':samples[i].get(key)}
-                            samples[i][f'EMBERS___{target}']['Original'].append(current_element)
-                        
-                self.filemanager.update_samples_json(pmc_number, samples)
-            logging.info(f'Aligning target: {target}...Done')
+                    logging.info(f'\t\tReusing transform code of {result["Source_PMC"]}')
+                    self.n_reused_transforms += 1
+                    reused = True
+
+                self.filemanager.write_transform_code(target, pmc_number, code_signature, result)
+
+            transform_code = result['Python_code']
+
+            if 'Conversion_possible' in result.keys() and result['Conversion_possible'] == 'yes':
+                inputs = []
+                for i in range(len(samples)):
+
+                    current_input = {}
+                    for key in keys:
+                        if key in samples[i].keys():
+                            current_input[key] = samples[i][key]
+                        else:
+                            current_input[key] = None
+                    inputs.append(current_input)
+
+                    samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
+                    for key in keys:
+                        current_element = {'key':key, 'value':samples[i].get(key)}
+                        samples[i][f'EMBERS___{target}']['Original'].append(current_element)
+
+                # The code is compiled once and applied to all samples in the sandboxed worker
+                transformed_values, errors, info = self.transform_runner.run(transform_code, inputs,
+                                                                             vectorized_source=result.get('Vectorized_code'))
+                for i, transformed_value in enumerate(transformed_values):
+                    samples[i][f'EMBERS___{target}']['Aligned'] = transformed_value
+                self.record_transform_errors(target, pmc_number, len(samples), errors, info)
+                if Config.TRANSFORM_LIBRARY and not reused and len(samples) > 0 and \
+                    len(errors) / len(samples) <= Config.TRANSFORM_LIBRARY_MAX_ERROR_RATE:
+                    self.add_to_library(signature, result, pmc_number)
+            else:
+                # no conversion possible
+                for i in range(len(samples)):
+                    samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
+                    for key in keys:
+                        current_element = {'key':key, 'value':samples[i].get(key)}
+                        samples[i][f'EMBERS___{target}']['Original'].append(current_element)
+        else:
+            # no special instructions
+            for i in range(len(samples)):
+                samples[i][f'EMBERS___{target}'] = {'Original':[], 'Aligned':None}
+                for key in keys:
+                    current_element = {'key':key, 'value':samples[i].get(key)}
+                    samples[i][f'EMBERS___{target}']['Original'].append(current_element)
+
+    def materialize_samples(self):
+        logging.info('Materializing integrated samples files...')
+        pmc_numbers = sorted(set(pmc_number for pmc_number, _ in self.filemanager.load_align_journal().keys()))
+        n_written = 0
+        for pmc_number in tqdm(pmc_numbers):
+            n_written += self.filemanager.materialize_samples_json(pmc_number)
+        logging.info(f'\tWritten: {n_written}, up to date: {len(pmc_numbers) - n_written}')
+        logging.info('Materializing integrated samples files...Done')
+
+    def log_progress(self, n_done, n_total, start_time):
+        elapsed = time.perf_counter() - start_time
+        rate = n_done / elapsed if elapsed > 0 else 0.0
+        eta = (n_total - n_done) / rate if rate > 0 else float('nan')
+        logging.info(f'\tProgress: {n_done}/{n_total} units, {rate:.2f} units/sec, '
+                     f'ETA {datetime.timedelta(seconds=int(eta)) if rate > 0 else "unknown"}, '
+                     f'LLM calls: {self.n_llm_calls}, reused transforms: {self.n_reused_transforms}')
+
+    def align_keys(self):
+        ###
+        # PMCごとに全ターゲットをまとめて処理し、samplesファイルの読み込みと書き出しを1回ずつにする
+        # 完了した(PMC, ターゲット)はジャーナルに記録し、再実行時はスキップする
+        ###
+        logging.info('Aligning keys...')
+
+        if not hasattr(self, 'integration'):
+            self.integration = self.filemanager.load_integration()
+        self.transform_stats = {}
+        self.filemanager.load_transform_code_registry()
+        self.transform_library = self.filemanager.load_transform_library()
+        self.transform_library_updated = False
+        self.n_llm_calls = 0
+        self.n_reused_transforms = 0
+
+        # Units (PMC, target) not completed by previous runs with the same reference keys and instructions
+        targets_by_pmc = {}
+        n_skipped = 0
+        for pmc_number, targets in self.group_targets_by_pmc().items():
+            remaining = [(target, original_key) for target, original_key in targets
+                         if self.journal.get((pmc_number, target), {}).get('Signature') != \
+                            self.unit_signature(target, original_key['Keys'])]
+            n_skipped += len(targets) - len(remaining)
+            if len(remaining) > 0:
+                targets_by_pmc[pmc_number] = remaining
+        n_total = sum(len(targets) for targets in targets_by_pmc.values())
+        logging.info(f'\tUnits to align: {n_total} (already aligned: {n_skipped})')
+
+        n_done = 0
+        start_time = time.perf_counter()
+        for pmc_number, targets in targets_by_pmc.items():
+            logging.info(f'Aligning PMC: {pmc_number} ({len(targets)} targets)')
+
+            samples = self.filemanager.load_samples_json(pmc_number)
+            for target, original_key in targets:
+                logging.info(f'\t{target}: {original_key}')
+                self.align_target(target,
+                                  pmc_number,
+                                  original_key['Keys'],
+                                  original_key['Keys_Info'],
+                                  samples)
+            self.filemanager.update_samples_json(pmc_number, samples)
+            self.filemanager.export_transform_code(pmc_number)
+            if self.transform_library_updated:
+                self.filemanager.write_transform_library(self.transform_library)
+                self.transform_library_updated = False
+
+            # The units are complete once the samples file is written
+            records = [{'PMC_ID': pmc_number,
+                        'Target': target,
+                        'Signature': self.unit_signature(target, original_key['Keys']),
+                        'Samples': len(samples),
+                        'Transform_stats': self.transform_stats.get(target, {}).get(pmc_number)}
+                       for target, original_key in targets]
+            self.filemanager.append_align_journal(records)
+            for record in records:
+                self.journal[(pmc_number, record['Target'])] = record
+            n_done += len(targets)
+            logging.info(f'Aligning PMC: {pmc_number}...Done')
+            self.log_progress(n_done, n_total, start_time)
+        self.transform_runner.stop()
+        self.filemanager.compact_transform_code_registry()
+        logging.info(f'\tLLM calls: {self.n_llm_calls}, reused transforms: {self.n_reused_transforms}')
+
+        # Per-transform error rates, including the units of previous runs
+        for (pmc_number, target), record in self.journal.items():
+            if record.get('Transform_stats') is not None:
+                self.transform_stats.setdefault(target, {}).setdefault(pmc_number, record['Transform_stats'])
+        self.filemanager.write_transform_stats(self.transform_stats)
+        for target, stats in self.transform_stats.items():
+            n_samples = sum(s['Samples'] for s in stats.values())
+            n_errors = sum(s['Errors'] for s in stats.values())
+            logging.info(f'\t{target}: {n_errors}/{n_samples} samples failed in {len(stats)} transforms')
+        logging.info('Aligning keys...Done')
 
 
 if __name__ == '__main__':
@@ -169,8 +338,23 @@ if __name__ == '__main__':
     filemanager = FileManager(config=Config)
     aligner = Aligner(llm=llm, filemanager=filemanager)
 
-    #aligner.clustering_result_extraction()
-    #aligner.keyname_variations()
-    #aligner.align_keys()
+    # Steps to run (default: extract, variations, align). An interrupted 'align' resumes from the journal.
+    # With SAMPLES_OVERLAY, the opt-in 'materialize' step writes the merged _samples_update_integrated.json
+    # files (only those older than their overlay or samples file) for tools that read them directly.
+    import sys
+    steps = sys.argv[1:] if len(sys.argv) > 1 else ['extract', 'variations', 'align']
+    if any(step not in ['extract', 'variations', 'align', 'materialize'] for step in steps):
+        logging.error('Usage: python main.py [extract] [variations] [align] [materialize]')
+        sys.exit(1)
+
+    if 'extract' in steps:
+        aligner.clustering_result_extraction()
+    if 'variations' in steps:
+        aligner.keyname_variations()
+    if 'align' in steps:
+        aligner.align_keys()
+    if 'materialize' in steps:
+        # Full _samples_update_integrated.json files from the overlays, for tools reading them directly
+        aligner.materialize_samples()
 
     logging.info('End analyzing process.')
\ No newline at end of file
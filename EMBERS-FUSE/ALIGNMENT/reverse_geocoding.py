@@ -0,0 +1,109 @@
+import re
+import json
+import logging
+import numpy as np
+
+# One coordinate component: decimal degrees or degrees/minutes/seconds, with an optional hemisphere
+COMPONENT_PATTERN = re.compile(r'''
+    (?P<sign>[-+])?\s*
+    (?P<deg>\d+(?:\.\d*)?)\s*(?:°|º|deg(?:rees)?|d\b)?\s*
+    (?:(?P<min>\d+(?:\.\d+)?)\s*(?:'|′|’|m\b|min\b))?\s*
+    (?:(?P<sec>\d+(?:\.\d+)?)\s*(?:"|″|''|”|s\b|sec\b))?\s*
+    (?P<hemi>[NSEW](?![a-z]))?
+''', re.VERBOSE | re.IGNORECASE)
+
+# Text allowed around the two components (labels and separators)
+LABEL_PATTERN = re.compile(r'\b(?:lat(?:itude)?|lon(?:g(?:itude)?)?)\b|[,;:/()=\s]', re.IGNORECASE)
+
+def parse_coordinates(text):
+    ###
+    # 緯度経度の文字列を(緯度, 経度)に変換する。座標でなければNoneを返す
+    # 例: '23.3080 113.4280', '29.2030 N 109.2020 E', '40°26\'46"N 79°58\'56"W', 'lat=-33.86, lon=151.21'
+    ###
+    if not isinstance(text, str):
+        return None
+    components = []
+    rest = []
+    position = 0
+    for match in COMPONENT_PATTERN.finditer(text):
+        if match.group('deg') is None:
+            continue
+        rest.append(text[position:match.start()])
+        position = match.end()
+        value = float(match.group('deg'))
+        if match.group('min') is not None:
+            value += float(match.group('min')) / 60
+        if match.group('sec') is not None:
+            value += float(match.group('sec')) / 3600
+        hemi = (match.group('hemi') or '').upper()
+        if match.group('sign') == '-' or hemi in ['S', 'W']:
+            value = -value
+        components.append((value, hemi))
+    rest.append(text[position:])
+    # Anything but labels and separators left over means this is not a coordinate pair
+    if len(components) != 2 or LABEL_PATTERN.sub('', ''.join(rest)) != '':
+        return None
+
+    (first, first_hemi), (second, second_hemi) = components
+    if first_hemi in ['E', 'W'] or second_hemi in ['N', 'S']:
+        first, second = second, first
+    lat, lon = first, second
+    if first_hemi == '' and second_hemi == '' and abs(lat) > 90 and abs(lon) <= 90:
+        # 'longitude latitude' order without hemispheres
+        lat, lon = lon, lat
+    if abs(lat) > 90 or abs(lon) > 180:
+        return None
+    return lat, lon
+
+class CountryIndex():
+    ###
+    # 国境ポリゴン(GeoJSON)のSTRtreeで、座標から国名を引くオフラインの逆ジオコーディング
+    ###
+    def __init__(self, boundaries_file, name_property='ADMIN', max_distance=0.5):
+        import shapely
+        from shapely.geometry import shape
+        with open(boundaries_file, 'r') as f:
+            features = json.load(f)['features']
+        self.names = [feature['properties'][name_property] for feature in features]
+        self.geometries = np.array([shape(feature['geometry']) for feature in features])
+        self.tree = shapely.STRtree(self.geometries)
+        # Points within this distance (degrees) of a coast are assigned to the nearest country
+        self.max_distance = max_distance
+        logging.info(f'Loaded {len(self.names)} country boundaries')
+
+    def lookup(self, coordinates):
+        """
+        Resolve the countries of many coordinates at once.
+
+        Parameters:
+            coordinates (list): (latitude, longitude) tuples.
+
+        Returns:
+            list: The country name of each coordinate (None if outside every country).
+        """
+        import shapely
+        if len(coordinates) == 0:
+            return []
+        coordinates = np.asarray(coordinates, dtype=float)
+        points = shapely.points(coordinates[:, 1], coordinates[:, 0])
+        countries = [None] * len(points)
+
+        point_indices, geometry_indices = self.tree.query(points, predicate='intersects')
+        for point_index, geometry_index in zip(point_indices, geometry_indices):
+            if countries[point_index] is None:
+                countries[point_index] = self.names[geometry_index]
+
+        unresolved = np.array([i for i, country in enumerate(countries) if country is None], dtype=int)
+        if len(unresolved) > 0 and self.max_distance > 0:
+            point_indices, geometry_indices = self.tree.query_nearest(points[unresolved], max_distance=self.max_distance)
+            for point_index, geometry_index in zip(point_indices, geometry_indices):
+                if countries[unresolved[point_index]] is None:
+                    countries[unresolved[point_index]] = self.names[geometry_index]
+        return countries
+
+def resolve_coordinates(locations, country_index):
+    # location -> country for the locations that are coordinate pairs
+    parsed = {location: parse_coordinates(location) for location in locations}
+    coordinate_locations = [location for location, coordinates in parsed.items() if coordinates is not None]
+    countries = country_index.lookup([parsed[location] for location in coordinate_locations])
+    return dict(zip(coordinate_locations, countries))
@@ -0,0 +1,56 @@
+import json
+import pytest
+from geocoding import GazetteerBackend, GeoCache
+
+COUNTRY_INFO = [('US', 'USA', 'United States'),
+                ('CA', 'CAN', 'Canada'),
+                ('MA', 'MAR', 'Morocco'),
+                ('GA', 'GAB', 'Gabon'),
+                ('DE', 'DEU', 'Germany')]
+
+ADMIN1_CODES = [('US.MA', 'Massachusetts'),
+                ('US.CA', 'California'),
+                ('US.GA', 'Georgia'),
+                ('US.SD', 'South Dakota'),
+                ('CA.08', 'Ontario'),
+                ('DE.16', 'Berlin')]
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    with open(tmp_path / 'countryInfo.txt', 'w') as f:
+        f.write('#ISO\tISO3\tISO-Numeric\tfips\tCountry\n')
+        for iso, iso3, country in COUNTRY_INFO:
+            f.write(f'{iso}\t{iso3}\t000\t{iso}\t{country}\n')
+    with open(tmp_path / 'admin1CodesASCII.txt', 'w') as f:
+        for code, name in ADMIN1_CODES:
+            f.write(f'{code}\t{name}\t{name}\t0\n')
+    return GazetteerBackend(str(tmp_path))
+
+@pytest.mark.parametrize('query, country', [('Boston, MA', 'United States'),
+                                            ('Los Angeles, CA', 'United States'),
+                                            ('Atlanta, GA', 'United States'),
+                                            ('Brookings, SD, USA', 'United States'),
+                                            ('Toronto, ON', 'Canada'),
+                                            ('Toronto, Ontario, Canada', 'Canada'),
+                                            ('Rabat, Morocco', 'Morocco'),
+                                            ('Berlin', 'Germany'),
+                                            ('MA', 'Morocco'),
+                                            ('CAN', 'Canada')])
+def test_gazetteer_geocode(gazetteer, query, country):
+    assert gazetteer.geocode(query) == country
+
+def test_gazetteer_unknown_two_letter_part(gazetteer):
+    # Not a known state/province abbreviation; left to the next backend
+    assert gazetteer.geocode('Paris, FR') is None
+
+def test_geocache_drops_old_region_code_records(tmp_path):
+    cache_file = tmp_path / 'cache.jsonl'
+    with open(cache_file, 'w') as f:
+        f.write(json.dumps({'Query': 'boston, ma', 'Country': 'Morocco'}) + '\n')
+        f.write(json.dumps({'Query': 'berlin', 'Country': 'Germany'}) + '\n')
+    cache = GeoCache(str(cache_file))
+    assert 'Boston, MA' not in cache
+    assert cache.get('Berlin') == 'Germany'
+
+    cache.add('Boston, MA', 'United States')
+    assert GeoCache(str(cache_file)).get('Boston, MA') == 'United States'
@@ -0,0 +1,321 @@
+import os
+import json
+import math
+import pickle
+import importlib
+import random
+import hashlib
+import logging
+import multiprocessing
+import subprocess
+import resource
+import time
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Imported in the worker before the memory limit is applied, so that their import-time
+# allocations (e.g. BLAS thread buffers) do not count against the generated code
+PRELOAD_MODULES = ['numpy', 'pandas']
+
+# Number of distinct inputs on which the vectorized output is checked against the row-wise output
+VECTORIZED_CHECK_SIZE = 20
+
+# Interval (seconds) at which the parent checks the resident memory of a running worker
+MEMORY_POLL_INTERVAL = 0.5
+
+def source_hash(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+def value_type(value):
+    # Coarse type class of a raw sample value
+    if value is None:
+        return 'none'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        text = value.strip()
+        if text == '':
+            return 'empty'
+        try:
+            float(text)
+            return 'numeric_str'
+        except ValueError:
+            return 'str'
+    return type(value).__name__
+
+def transform_signature(target, keys, samples_key_values, instructions=None):
+    ###
+    # 変換コードライブラリのキー: ターゲット、ソートした参照キー、サンプル値の型の組み合わせ、
+    # ターゲットのinstructionsのハッシュ (instructionsを変更すると以前のコードは再利用されない)
+    ###
+    fingerprint = {key: sorted(set(value_type(values.get(key)) for values in samples_key_values))
+                   for key in keys}
+    return json.dumps([target, sorted(keys), [fingerprint[key] for key in sorted(keys)],
+                       source_hash(json.dumps(instructions))])
+
+def registry_signature(target, keys, instructions):
+    # Registered transform code is only valid for the same reference keys and instructions
+    return source_hash(json.dumps([target, sorted(keys), instructions]))
+
+# Compiled transform functions in the worker process, keyed by source hash
+_function_cache = {}
+
+def load_transform_function(source, name='transform_data'):
+    key = source_hash(source)
+    if key not in _function_cache:
+        # 'input' is a global of the generated code, as when it was exec'd per sample (set by apply_rowwise)
+        namespace = {'input': None}
+        exec(compile(source, f'<transform_{key[:12]}>', 'exec'), namespace)
+        _function_cache[key] = namespace
+    return _function_cache[key][name]
+
+def input_key(current_input):
+    # Hashable key of an input dict, used to transform each distinct input only once
+    return json.dumps(current_input, sort_keys=True, default=str)
+
+def to_json_value(value):
+    # Plain Python value for the samples JSON: numpy scalars via .item(), NaN and pandas NA/NaT as None
+    if isinstance(value, dict):
+        return {key: to_json_value(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(v) for v in value]
+    if type(value).__name__ in ['NAType', 'NaTType']:
+        return None
+    if type(value).__module__ == 'numpy' and hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def same_outputs(a, b):
+    # Strict comparison (e.g. 1 and 1.0 differ, as they would in the JSON)
+    return json.dumps(a, sort_keys=True, default=str) == json.dumps(b, sort_keys=True, default=str)
+
+def apply_rowwise(transform_data, inputs):
+    outputs = [None] * len(inputs)
+    errors = []
+    namespace = transform_data.__globals__
+    for i, current_input in enumerate(inputs):
+        namespace['input'] = current_input
+        try:
+            outputs[i] = transform_data(current_input)
+        except Exception as e:
+            errors.append((i, f'{type(e).__name__}: {e}'))
+    return outputs, errors
+
+def apply_vectorized(transform_data_vectorized, inputs):
+    # Columns of the reference key values, as pandas Series
+    import pandas as pd
+    columns = {key: pd.Series([current_input[key] for current_input in inputs], dtype=object)
+               for key in inputs[0].keys()}
+    outputs = transform_data_vectorized(columns)
+    outputs = outputs.tolist() if hasattr(outputs, 'tolist') else list(outputs)
+    if len(outputs) != len(inputs):
+        raise ValueError(f'Vectorized transform returned {len(outputs)} values for {len(inputs)} inputs')
+    return outputs
+
+def transform_worker(conn, memory_limit):
+    ###
+    # 変換コードを実行するワーカープロセス
+    # (source, inputs, vectorized_source)を受け取り、異なる入力ごとに1回だけ変換して(outputs, errors, info)を返す
+    # ベクトル化コードがあれば列単位で適用し、失敗した場合や抽出した入力で行単位の出力と一致しない場合は行単位にフォールバックする
+    ###
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    if memory_limit is not None:
+        try:
+            # The limit is on top of the address space already used by the interpreter and preloaded modules
+            with open('/proc/self/statm', 'r') as f:
+                used = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            used = 0
+        limit = used + memory_limit
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError) as e:
+            # Not supported on every platform (e.g. macOS)
+            logging.warning(f'Transform worker: RLIMIT_AS could not be applied ({e}); '
+                            'the memory limit is enforced by polling the worker from the parent only')
+    # Baseline reached: the parent measures the memory used by transforms from here
+    conn.send('ready')
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        source, inputs, vectorized_source = request
+
+        # Value-level memoization: many samples share the same raw values (e.g. sex, country)
+        distinct_index = {}
+        inverse = []
+        for current_input in inputs:
+            inverse.append(distinct_index.setdefault(input_key(current_input), len(distinct_index)))
+        distinct_inputs = [None] * len(distinct_index)
+        for current_input, j in zip(inputs, inverse):
+            distinct_inputs[j] = current_input
+        info = {'Distinct_inputs': len(distinct_inputs), 'Mode': 'rowwise'}
+
+        try:
+            transform_data = load_transform_function(source)
+        except Exception as e:
+            conn.send(([None] * len(inputs), [(i, f'Compile error: {e}') for i in range(len(inputs))], info))
+            continue
+
+        distinct_outputs = None
+        distinct_errors = []
+        if vectorized_source is not None and len(distinct_inputs) > 0:
+            try:
+                vectorized_outputs = apply_vectorized(load_transform_function(vectorized_source, 'transform_data_vectorized'),
+                                                      distinct_inputs)
+                vectorized_outputs = [to_json_value(output) for output in vectorized_outputs]
+                # The vectorized code is only used if it agrees with the row-wise code on sampled inputs
+                check_indices = random.Random(0).sample(range(len(distinct_inputs)),
+                                                        min(len(distinct_inputs), VECTORIZED_CHECK_SIZE))
+                check_outputs, _ = apply_rowwise(transform_data, [distinct_inputs[k] for k in check_indices])
+                if all(same_outputs(vectorized_outputs[k], to_json_value(output))
+                       for k, output in zip(check_indices, check_outputs)):
+                    distinct_outputs = vectorized_outputs
+                    info['Mode'] = 'vectorized'
+                else:
+                    info['Vectorized_error'] = 'Output differs from the row-wise transform on sampled inputs'
+            except Exception as e:
+                info['Vectorized_error'] = f'{type(e).__name__}: {e}'
+        if distinct_outputs is None:
+            distinct_outputs, distinct_errors = apply_rowwise(transform_data, distinct_inputs)
+            distinct_outputs = [to_json_value(output) for output in distinct_outputs]
+
+        distinct_errors = dict(distinct_errors)
+        outputs = [distinct_outputs[j] for j in inverse]
+        errors = [(i, distinct_errors[j]) for i, j in enumerate(inverse) if j in distinct_errors]
+        try:
+            conn.send((outputs, errors, info))
+        except Exception:
+            # Some outputs cannot be pickled (and could not be written to JSON either)
+            for i, output in enumerate(outputs):
+                try:
+                    pickle.dumps(output)
+                except Exception as e:
+                    outputs[i] = None
+                    errors.append((i, f'Unserializable output: {e}'))
+            conn.send((outputs, errors, info))
+
+def process_rss(pid):
+    # Resident memory of a process in bytes (None if it cannot be measured)
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # macOS: ps reports the resident set size in kilobytes
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)], capture_output=True, text=True, timeout=5).stdout
+        return int(output.strip()) * 1024
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+class TransformRunner():
+    ###
+    # LLMが生成した変換コードを別プロセスで実行するクラス
+    # コードはソースのハッシュごとに1回だけコンパイルし、時間・メモリの上限を超えたらワーカーを作り直す
+    # メモリの上限はワーカー内のRLIMIT_ASに加えて、親プロセスがワーカーのRSSを監視して適用する
+    # (RLIMIT_ASが効かないmacOSなどでも上限を超えたワーカーを止める)
+    ###
+    def __init__(self, timeout=600, memory_limit=2 * 1024**3):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=transform_worker,
+                                            args=(child_conn, self.memory_limit),
+                                            daemon=True)
+        self.process.start()
+        child_conn.close()
+        # Wait until the worker has preloaded its modules, so that they are part of the baseline
+        try:
+            if self.conn.poll(self.timeout):
+                self.conn.recv()
+        except (EOFError, OSError):
+            pass
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def run(self, source, inputs, vectorized_source=None):
+        """
+        Apply the transform_data function defined in source to every input.
+
+        Parameters:
+            source (str): The generated Python code defining transform_data(input).
+            inputs (list): The input dicts, one per sample.
+            vectorized_source (str): Optional generated code defining transform_data_vectorized(columns),
+                which takes a dict of reference key -> pandas Series and returns the transformed values.
+                It is tried first, and source is used row by row if it fails or its output differs
+                from the row-wise output on sampled inputs.
+
+        Returns:
+            tuple: (outputs, errors, info), the transformed values as plain JSON values (None where the
+            transform failed or returned NaN),
+            a list of (input index, error message), and a dict with the number of distinct inputs
+            and the mode used ('vectorized' or 'rowwise').
+        """
+        if self.process is None or not self.process.is_alive():
+            self.start()
+        try:
+            # Memory of the idle worker (interpreter, preloaded modules, compiled functions)
+            baseline = process_rss(self.process.pid) if self.memory_limit is not None else None
+            self.conn.send((source, inputs, vectorized_source))
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    message = f'Timeout after {self.timeout} seconds'
+                    break
+                if self.conn.poll(min(MEMORY_POLL_INTERVAL, remaining)):
+                    return self.conn.recv()
+                if baseline is None:
+                    continue
+                rss = process_rss(self.process.pid)
+                if rss is not None and rss > baseline + self.memory_limit:
+                    message = f'Memory limit exceeded ({rss / 1024**2:.0f} MB resident)'
+                    break
+        except (EOFError, BrokenPipeError, OSError):
+            # The worker died, e.g. by exceeding the memory limit
+            message = 'Transform worker terminated'
+        logging.info(f'\t\t{message}; restarting transform worker')
+        self.process.kill()
+        self.stop()
+        return [None] * len(inputs), [(i, message) for i in range(len(inputs))], {'Mode': 'failed'}
@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import itertools
+import resource
+import logging
+import datetime
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+from config import Config
+from filemanager import FileManager
+from main import RunCluster
+import cluster
+
+# Parameter grid of the sweep
+UMAP_N_NEIGHBORS = [5, 15, 30]
+UMAP_MIN_DIST = [0.0, 0.01, 0.1]
+HDBSCAN_MIN_CLUSTER_SIZE = [10, 20, 50]
+LEIDEN_N_NEIGHBORS = [5, 15, 30]
+LEIDEN_RESOLUTION = [0.005, 0.01, 0.05]
+# Each setting is run with these seeds; stability is the agreement between seeds
+SEEDS = [0, 1, 2]
+N_WORKERS = 4
+
+def peak_memory_mb():
+    # Peak RSS of this process; ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def sweep_files(entity):
+    return {name: os.path.join(Config.OUT_DIR, f'{entity}_sweep_{name}.npy')
+            for name in ['embeddings', 'knn_indices', 'knn_distances']}
+
+def prepare_inputs(entity, n_samples=None):
+    ###
+    # キャッシュ済みの埋め込みとkNNグラフを読み込み、ワーカーがメモリマップで共有できるnpyに書き出す
+    ###
+    files = FileManager(data_dir=Config.DATA_DIR,
+                        out_dir=Config.OUT_DIR)
+    runcluster = RunCluster(llm=None, filemanager=files)
+    if entity == 'project':
+        _, embs = files.load_project()
+    else:
+        _, embs, _ = files.load_methods()
+    embs = cluster.normalize_l2_chunked(embs, dim=getattr(Config, f'EMB_DIM_{entity.upper()}'))
+    embs = runcluster.reduce(entity, embs, getattr(Config, f'REDUCTION_{entity.upper()}'))
+
+    if n_samples is not None and n_samples < embs.shape[0]:
+        # The cached kNN graph covers all embeddings, so a subsample gets its own (unsaved) index
+        rng = np.random.default_rng(0)
+        embs = embs[np.sort(rng.choice(embs.shape[0], n_samples, replace=False))]
+        knn_index = cluster.build_knn_index(embs, n_neighbors=Config.KNN_INDEX_N_NEIGHBORS)
+    else:
+        knn_index = runcluster.knn_index(entity, embs)
+        if knn_index is None:
+            knn_index = cluster.build_knn_index(embs, n_neighbors=Config.KNN_INDEX_N_NEIGHBORS)
+
+    paths = sweep_files(entity)
+    indices, distances = knn_index.neighbor_graph
+    np.save(paths['embeddings'], embs)
+    np.save(paths['knn_indices'], indices)
+    np.save(paths['knn_distances'], distances)
+    return embs.shape[0], indices.shape[1]
+
+def run_umap_hdbscan(entity, n_neighbors, min_dist, seed):
+    # One UMAP embedding is shared by all HDBSCAN min_cluster_size values
+    paths = sweep_files(entity)
+    embs = np.load(paths['embeddings'], mmap_mode='r')
+    knn_graph = (np.load(paths['knn_indices']), np.load(paths['knn_distances']))
+    start = time.perf_counter()
+    coords_2d = cluster.emb_2d_umap(embs,
+                                    n_neighbors=n_neighbors,
+                                    min_dist=min_dist,
+                                    knn_index=knn_graph,
+                                    random_state=seed)
+    umap_time = time.perf_counter() - start
+    results = []
+    for min_cluster_size in HDBSCAN_MIN_CLUSTER_SIZE:
+        start = time.perf_counter()
+        cluster_indices = cluster.run_hdbscan_clustering(coords_2d, min_cluster_size=min_cluster_size)
+        results.append({'Method': 'umap_hdbscan',
+                        'Params': f'n_neighbors={n_neighbors},min_dist={min_dist},min_cluster_size={min_cluster_size}',
+                        'Seed': seed,
+                        'Runtime': umap_time + time.perf_counter() - start,
+                        'Cluster_indices': cluster_indices})
+    # Every task runs in a fresh process
+    peak_memory = peak_memory_mb()
+    for result in results:
+        result['Peak_memory_MB'] = peak_memory
+    return results
+
+def run_leiden(entity, n_neighbors, resolution, seed):
+    paths = sweep_files(entity)
+    knn_graph = (np.load(paths['knn_indices']), np.load(paths['knn_distances']))
+    start = time.perf_counter()
+    cluster_indices = cluster.run_leiden_clustering(None,
+                                                    n_neighbors=n_neighbors,
+                                                    resolution=resolution,
+                                                    knn_index=knn_graph,
+                                                    seed=seed)
+    return [{'Method': 'leiden',
+             'Params': f'n_neighbors={n_neighbors},resolution={resolution}',
+             'Seed': seed,
+             'Runtime': time.perf_counter() - start,
+             'Peak_memory_MB': peak_memory_mb(),
+             'Cluster_indices': cluster_indices}]
+
+def stability(labelings):
+    # Mean pairwise ARI and NMI between the runs with different seeds
+    pairs = list(itertools.combinations(labelings, 2))
+    if len(pairs) == 0:
+        return float('nan'), float('nan')
+    ari = np.mean([adjusted_rand_score(a, b) for a, b in pairs])
+    nmi = np.mean([normalized_mutual_info_score(a, b) for a, b in pairs])
+    return ari, nmi
+
+def sweep(entity, n_samples=None):
+    ###
+    # パラメータグリッドの各設定を複数シードで並列に実行し、
+    # 実行時間・ピークメモリ・クラスタ数・シード間の安定性(ARI/NMI)を表にまとめる
+    ###
+    logging.info(f'Start clustering parameter sweep of {entity}')
+    n, max_neighbors = prepare_inputs(entity, n_samples=n_samples)
+    logging.info(f'\tNumber of embeddings: {n}')
+    if max(UMAP_N_NEIGHBORS) > max_neighbors or max(LEIDEN_N_NEIGHBORS) + 1 > max_neighbors:
+        logging.error(f'\tThe kNN graph has only {max_neighbors} neighbours; increase KNN_INDEX_N_NEIGHBORS')
+        return
+
+    tasks = [(run_umap_hdbscan, (entity, nn, md, seed))
+             for nn, md, seed in itertools.product(UMAP_N_NEIGHBORS, UMAP_MIN_DIST, SEEDS)]
+    tasks += [(run_leiden, (entity, nn, res, seed))
+              for nn, res, seed in itertools.product(LEIDEN_N_NEIGHBORS, LEIDEN_RESOLUTION, SEEDS)]
+    logging.info(f'\tNumber of tasks: {len(tasks)}')
+
+    runs = {}
+    context = multiprocessing.get_context('spawn')
+    # A fresh process per task, so that the peak memory is measured per setting
+    with ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=context, max_tasks_per_child=1) as executor:
+        futures = [executor.submit(func, *args) for func, args in tasks]
+        for i, future in enumerate(as_completed(futures)):
+            for result in future.result():
+                runs.setdefault((result['Method'], result['Params']), []).append(result)
+            logging.info(f'\t\tFinished {i+1}/{len(tasks)} tasks')
+
+    header = ['Method', 'Params', 'Runtime', 'Peak_memory_MB', 'N_clusters', 'Noise_fraction', 'ARI_stability', 'NMI_stability']
+    rows = []
+    for (method, params), results in runs.items():
+        labelings = [r['Cluster_indices'] for r in sorted(results, key=lambda r: r['Seed'])]
+        ari, nmi = stability(labelings)
+        rows.append([method,
+                     params,
+                     f"{np.mean([r['Runtime'] for r in results]):.1f}",
+                     f"{max(r['Peak_memory_MB'] for r in results):.0f}",
+                     f"{np.mean([l.max() + 1 for l in labelings]):.1f}",
+                     f"{np.mean([(l == -1).mean() for l in labelings]):.3f}",
+                     f'{ari:.3f}',
+                     f'{nmi:.3f}'])
+    rows.sort(key=lambda row: (row[0], row[1]))
+
+    out_file = os.path.join(Config.OUT_DIR, f'{entity}_clustering_sweep.tsv')
+    with open(out_file, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\n')
+    for row in [header] + rows:
+        logging.info('\t' + '\t'.join(str(v) for v in row))
+
+    for path in sweep_files(entity).values():
+        os.remove(path)
+    logging.info(f'End clustering parameter sweep of {entity}: {out_file}')
+
+if __name__ == '__main__':
+    ### setup_logging()
+    logger = logging.getLogger('')
+    logger.setLevel(logging.INFO)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    current_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    file_handler = logging.FileHandler(os.path.join(Config.LOG_DIR, f'log_benchmark_clustering_{current_time}.txt'))
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(stream_handler)
+    logger.addHandler(file_handler)
+    ###
+
+    if len(sys.argv) not in [2, 3] or sys.argv[1] not in ['project', 'methods']:
+        logging.error('Usage: python benchmark_clustering.py project|methods [n_samples]')
+        sys.exit(1)
+
+    sweep(sys.argv[1], n_samples=int(sys.argv[2]) if len(sys.argv) == 3 else None)
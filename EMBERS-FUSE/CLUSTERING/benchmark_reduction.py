@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import resource
+import logging
+import datetime
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.cluster.hierarchy import fcluster
+from sklearn.metrics import adjusted_rand_score
+from config import Config
+from filemanager import FileManager
+import cluster
+
+# Reductions compared against the full dimensionality (None)
+REDUCTIONS = [None,
+              {'method': 'pca', 'n_components': 64},
+              {'method': 'pca', 'n_components': 128},
+              {'method': 'pca', 'n_components': 256},
+              {'method': 'pca', 'n_components': 512},
+              {'method': 'random_projection', 'n_components': 256},
+              {'method': 'random_projection', 'n_components': 512},
+              {'method': 'random_projection', 'n_components': 1024}]
+
+def peak_memory_mb():
+    # Peak RSS of this process; ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def load_embeddings(entity):
+    files = FileManager(data_dir=Config.DATA_DIR,
+                        out_dir=Config.OUT_DIR)
+    if entity == 'project':
+        _, embs = files.load_project()
+    elif entity == 'methods':
+        _, embs, _ = files.load_methods()
+    else:
+        _, embs = files.load_keys()
+    return embs
+
+def run_pipeline(entity, reduction, sample_indices):
+    ###
+    # 1つの設定で次元削減とクラスタリングを実行し、実行時間・ピークメモリ・クラスタ番号を返す
+    # ピークメモリを設定ごとに測れるよう、別プロセスで実行する
+    ###
+    embs = load_embeddings(entity)
+    if entity == 'keys':
+        # Same input as run_keys (no truncation)
+        embs = np.asarray(embs[sample_indices], dtype=np.float32)
+    else:
+        embs = cluster.normalize_l2_chunked(embs[sample_indices],
+                                            dim=getattr(Config, f'EMB_DIM_{entity.upper()}'))
+
+    start = time.perf_counter()
+    if reduction is not None:
+        reducer = cluster.fit_reducer(embs, method=reduction['method'], n_components=reduction['n_components'])
+        embs = cluster.reduce_embeddings(embs, reducer)
+    reduction_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if entity == 'keys':
+        # Keys are clustered on the hierarchical linkage; cut it at a fixed number of clusters
+        Z = cluster.build_linkage(embs,
+                                  backend=Config.KEYS_LINKAGE_BACKEND,
+                                  n_neighbors=Config.KEYS_LINKAGE_N_NEIGHBORS,
+                                  memory_limit=Config.KEYS_LINKAGE_MEMORY_LIMIT)
+        cluster_indices = fcluster(Z, t=max(2, embs.shape[0] // Config.KEYS_MIN_SIZE), criterion='maxclust') - 1
+    else:
+        coords_2d = cluster.emb_2d_umap(embs,
+                                        n_neighbors=getattr(Config, f'N_NEIGHBORS_{entity.upper()}'),
+                                        min_dist=getattr(Config, f'MIN_DIST_{entity.upper()}'))
+        cluster_indices = cluster.run_hdbscan_clustering(coords_2d,
+                                                         min_cluster_size=getattr(Config, f'MIN_CLUSTER_SIZE_{entity.upper()}'))
+    clustering_time = time.perf_counter() - start
+
+    peak_memory = peak_memory_mb()
+    return {'Dim': embs.shape[1],
+            'Reduction_time': reduction_time,
+            'Clustering_time': clustering_time,
+            'Peak_memory_MB': peak_memory,
+            'Cluster_indices': cluster_indices}
+
+def reduction_name(reduction):
+    if reduction is None:
+        return 'full'
+    return f"{reduction['method']}_{reduction['n_components']}"
+
+def benchmark(entity, n_samples=None):
+    ###
+    # 各次元削減設定について、元の次元でのクラスタリングに対するARIを計算して表にまとめる
+    ###
+    logging.info(f'Start benchmarking dimensionality reduction of {entity}')
+    n = load_embeddings(entity).shape[0]
+    rng = np.random.default_rng(0)
+    if n_samples is not None and n_samples < n:
+        sample_indices = np.sort(rng.choice(n, n_samples, replace=False))
+    else:
+        sample_indices = np.arange(n)
+    logging.info(f'\tNumber of embeddings: {len(sample_indices)}')
+
+    # The full-dimensional pipeline is run twice to show the run-to-run agreement (noise floor)
+    runs = [('full_repeat', None)] + [(reduction_name(r), r) for r in REDUCTIONS]
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, reduction in runs:
+        logging.info(f'\tRunning {name}...')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(run_pipeline, entity, reduction, sample_indices).result()
+        logging.info(f'\tRunning {name}...Done')
+
+    reference = results['full']['Cluster_indices']
+    header = ['Reduction', 'Dim', 'Reduction_time', 'Clustering_time', 'Peak_memory_MB', 'N_clusters', 'ARI_vs_full']
+    rows = []
+    for name, _ in runs:
+        result = results[name]
+        rows.append([name,
+                     result['Dim'],
+                     f"{result['Reduction_time']:.1f}",
+                     f"{result['Clustering_time']:.1f}",
+                     f"{result['Peak_memory_MB']:.0f}",
+                     int(result['Cluster_indices'].max()) + 1,
+                     f"{adjusted_rand_score(reference, result['Cluster_indices']):.3f}"])
+
+    out_file = os.path.join(Config.OUT_DIR, f'{entity}_reduction_benchmark.tsv')
+    with open(out_file, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\n')
+    for row in [header] + rows:
+        logging.info('\t' + '\t'.join(str(v) for v in row))
+    logging.info(f'End benchmarking dimensionality reduction of {entity}: {out_file}')
+
+if __name__ == '__main__':
+    ### setup_logging()
+    logger = logging.getLogger('')
+    logger.setLevel(logging.INFO)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    current_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    file_handler = logging.FileHandler(os.path.join(Config.LOG_DIR, f'log_benchmark_reduction_{current_time}.txt'))
+    file_handler.setLevel(logging.DEBUG)
+    logger.addHandler(stream_handler)
+    logger.addHandler(file_handler)
+    ###
+
+    if len(sys.argv) not in [2, 3] or sys.argv[1] not in ['project', 'methods', 'keys']:
+        logging.error('Usage: python benchmark_reduction.py project|methods|keys [n_samples]')
+        sys.exit(1)
+
+    benchmark(sys.argv[1], n_samples=int(sys.argv[2]) if len(sys.argv) == 3 else None)
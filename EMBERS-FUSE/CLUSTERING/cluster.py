@@ -1,16 +1,21 @@
 import json
+from collections import Counter
 import numpy as np
 import umap
+from pynndescent import NNDescent
+from scipy.sparse import csr_matrix, coo_matrix, triu
 from sklearn.cluster import HDBSCAN
 import leidenalg
 import igraph
-from sklearn.neighbors import NearestNeighbors
-from collections import deque
+from sklearn.neighbors import NearestNeighbors, kneighbors_graph
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.cluster.hierarchy import linkage,  to_tree
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.cluster import KMeans, AgglomerativeClustering
 from sklearn.preprocessing import StandardScaler
 import random
+import pickle
 import logging
 
 def normalize_l2(x):
@@ -24,105 +29,579 @@ def normalize_l2(x):
         norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
         return np.where(norm == 0, x, x / norm)
 
-def emb_2d_umap(ALL_EMBEDDINGS, n_neighbors, min_dist):
+def normalize_l2_chunked(x, dim=None, chunk_size=65536):
+    """
+    L2-normalize the rows of a (possibly memory-mapped) matrix chunk by chunk.
+
+    Parameters:
+        x (np.array): The input matrix of shape (num_samples, num_features).
+        dim (int): If given, only the first `dim` columns are used.
+        chunk_size (int): The number of rows normalized at a time.
+
+    Returns:
+        np.array: The normalized float32 matrix. A writable float32 input is normalized in place;
+        otherwise (e.g. a read-only memory map) a single float32 copy is made.
+    """
+    if dim is None or dim >= x.shape[1]:
+        dim = x.shape[1]
+    if x.dtype == np.float32 and x.flags.writeable and dim == x.shape[1]:
+        out = x
+    else:
+        out = np.empty((x.shape[0], dim), dtype=np.float32)
+    for start in range(0, x.shape[0], chunk_size):
+        chunk = np.asarray(x[start:start + chunk_size, :dim], dtype=np.float32)
+        norm = np.linalg.norm(chunk, 2, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        out[start:start + chunk_size] = chunk / norm
+    return out
+
+def fit_reducer(embeddings, method='pca', n_components=256, chunk_size=10000):
+    """
+    Fit a dimensionality reduction of the embeddings.
+
+    Parameters:
+        embeddings (np.array): The input embeddings of shape (num_samples, num_features).
+        method (str): 'pca' for incremental PCA, fitted chunk by chunk,
+            'random_projection' for a sparse random projection (data independent, no pass over the data).
+        n_components (int): The number of output dimensions.
+        chunk_size (int): The number of rows used per partial fit ('pca').
+
+    Returns:
+        IncrementalPCA or SparseRandomProjection: The fitted reducer.
+    """
+    if method == 'pca':
+        reducer = IncrementalPCA(n_components=n_components)
+        # Every partial fit needs at least n_components rows, so the last short chunk is merged
+        starts = list(range(0, embeddings.shape[0], max(chunk_size, n_components)))
+        if len(starts) > 1 and embeddings.shape[0] - starts[-1] < n_components:
+            starts = starts[:-1]
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else embeddings.shape[0]
+            reducer.partial_fit(np.asarray(embeddings[start:end], dtype=np.float32))
+    elif method == 'random_projection':
+        reducer = SparseRandomProjection(n_components=n_components, dense_output=True)
+        reducer.fit(np.asarray(embeddings[:1], dtype=np.float32))
+    else:
+        raise ValueError(f'Unknown reduction method: {method}')
+    return reducer
+
+def reduce_embeddings(embeddings, reducer, chunk_size=65536):
+    """
+    Project the embeddings with a fitted reducer, chunk by chunk.
+
+    Parameters:
+        embeddings (np.array): The input embeddings of shape (num_samples, num_features).
+        reducer (IncrementalPCA or SparseRandomProjection): The reducer returned by fit_reducer.
+        chunk_size (int): The number of rows projected at a time.
+
+    Returns:
+        np.array: The L2-normalized float32 projections, so that cosine distances stay meaningful downstream.
+    """
+    n_components = reducer.n_components_ if hasattr(reducer, 'n_components_') else reducer.n_components
+    out = np.empty((embeddings.shape[0], n_components), dtype=np.float32)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        out[start:start + chunk_size] = reducer.transform(np.asarray(embeddings[start:start + chunk_size],
+                                                                     dtype=np.float32))
+    return normalize_l2_chunked(out)
+
+def build_knn_index(embeddings, n_neighbors=64):
+    """
+    Build an approximate nearest-neighbour (NN-descent) index with cosine metric.
+
+    Parameters:
+        embeddings (np.array): The input embeddings of shape (num_samples, num_features).
+        n_neighbors (int): The number of neighbours kept in the kNN graph (including the point itself).
+
+    Returns:
+        NNDescent: The index. index.neighbor_graph is the (indices, distances) kNN graph of the
+        embeddings, and index.query() searches neighbours of new points.
+    """
+    logging.info('\tBuilding approximate kNN index...')
+    index = NNDescent(np.asarray(embeddings, dtype=np.float32),
+                      metric='cosine',
+                      n_neighbors=n_neighbors,
+                      random_state=0,
+                      verbose=True)
+    index.prepare()
+    logging.info('\tBuilding approximate kNN index...Done')
+    return index
+
+def knn_from_index(knn_index, n_neighbors):
+    # kNN graph with n_neighbors columns, the first of which is the point itself.
+    # knn_index is an NNDescent index or an (indices, distances) tuple of its neighbour graph.
+    if isinstance(knn_index, tuple):
+        indices, distances = knn_index
+    else:
+        indices, distances = knn_index.neighbor_graph
+    return indices[:, :n_neighbors], distances[:, :n_neighbors]
+
+def emb_2d_umap(ALL_EMBEDDINGS, n_neighbors, min_dist, knn_index=None, random_state=None):
+    if knn_index is not None:
+        # Reuse the persistent kNN index instead of recomputing the neighbours
+        indices, distances = knn_from_index(knn_index, n_neighbors)
+        precomputed_knn = (indices, distances, None if isinstance(knn_index, tuple) else knn_index)
+    else:
+        precomputed_knn = (None, None, None)
     model = umap.UMAP(verbose=True,
                       n_neighbors=n_neighbors,
                       min_dist=min_dist,
                       n_components=2,
-                      metric='cosine')
+                      metric='cosine',
+                      precomputed_knn=precomputed_knn,
+                      random_state=random_state)
     result = model.fit_transform(ALL_EMBEDDINGS)
     return result
 
+def fit_umap_on_sample(ALL_EMBEDDINGS, n_neighbors, min_dist, n_fit=100000, model_file=None,
+                       max_candidates=1000000, n_pca_fit=20000, chunk_size=20000):
+    """
+    Fit UMAP on a diversity-preserving sample of the embeddings.
+
+    Parameters:
+        ALL_EMBEDDINGS (np.array): The input embeddings of shape (num_samples, num_features), possibly memory-mapped.
+        n_neighbors (int): UMAP n_neighbors.
+        min_dist (float): UMAP min_dist.
+        n_fit (int): The number of embeddings the model is fitted on.
+        model_file (str): If given, the fitted model is pickled to this file.
+        max_candidates (int): The maximum size of the random candidate pool the sample is drawn from.
+        n_pca_fit (int): The number of candidates the scaler and PCA of the sampling are fitted on.
+        chunk_size (int): The number of candidates projected to the PCA space at a time.
+
+    Returns:
+        tuple: (model, fit_indices), the fitted UMAP model and the indices of the embeddings it was fitted on
+        (model.embedding_ holds their 2D coordinates).
+
+    The sample is drawn as in sample_by_pca_clustering (K-Means clusters in a 50-dimensional PCA space)
+    from a random candidate pool of min(10 * n_fit, max_candidates) embeddings. The scaler and PCA are
+    fitted in float32 on a small subset, and the candidates are projected chunk by chunk, so only the
+    PCA projections and the n_fit rows UMAP is fitted on are held in memory.
+    """
+    n = ALL_EMBEDDINGS.shape[0]
+    n_candidates = min(n, 10 * n_fit, max_candidates)
+    candidate_indices = np.sort(np.random.choice(n, n_candidates, replace=False))
+
+    pca_fit_indices = np.sort(np.random.choice(candidate_indices, min(n_candidates, n_pca_fit), replace=False))
+    pca_fit_data = np.asarray(ALL_EMBEDDINGS[pca_fit_indices], dtype=np.float32)
+    scaler = StandardScaler().fit(pca_fit_data)
+    pca = PCA(n_components=50).fit(scaler.transform(pca_fit_data))
+    del pca_fit_data
+    candidates_transformed = np.empty((n_candidates, pca.n_components_), dtype=np.float32)
+    for start in range(0, n_candidates, chunk_size):
+        chunk = np.asarray(ALL_EMBEDDINGS[candidate_indices[start:start + chunk_size]], dtype=np.float32)
+        candidates_transformed[start:start + chunk_size] = pca.transform(scaler.transform(chunk))
+
+    kmeans = KMeans(n_clusters=100, random_state=0)
+    clusters = kmeans.fit_predict(candidates_transformed)
+    sampled = sample_from_clusters(clusters, n_samples=n_fit, n_clusters=100)
+    fit_indices = np.unique(candidate_indices[sampled])
+
+    logging.info(f'\tFitting UMAP on {len(fit_indices)} of {n} embeddings...')
+    model = umap.UMAP(verbose=True,
+                      n_neighbors=n_neighbors,
+                      min_dist=min_dist,
+                      n_components=2,
+                      metric='cosine')
+    model.fit(np.asarray(ALL_EMBEDDINGS[fit_indices], dtype=np.float32))
+    if model_file is not None:
+        with open(model_file, 'wb') as f:
+            pickle.dump(model, f)
+    logging.info(f'\tFitting UMAP on {len(fit_indices)} of {n} embeddings...Done')
+    return model, fit_indices
+
+# UMAP model loaded once per worker process of transform_umap
+_umap_model = None
+
+def _init_umap_worker(model_file):
+    global _umap_model
+    with open(model_file, 'rb') as f:
+        _umap_model = pickle.load(f)
+
+def _umap_transform_chunk(chunk):
+    return _umap_model.transform(chunk)
+
+def transform_umap(model_file, embeddings, indices=None, n_workers=4, chunk_size=20000):
+    """
+    Project embeddings with a fitted UMAP model, in chunks across a process pool.
+
+    Parameters:
+        model_file (str): The pickled UMAP model written by fit_umap_on_sample.
+        embeddings (np.array): The embeddings of shape (num_samples, num_features), possibly memory-mapped.
+        indices (np.array): The sorted row indices to project (all rows if None).
+        n_workers (int): The number of worker processes.
+        chunk_size (int): The number of embeddings projected per task.
+
+    Returns:
+        np.array: The 2D coordinates of the projected rows, in the order of indices.
+    """
+    n = embeddings.shape[0] if indices is None else len(indices)
+    result = np.zeros((n, 2), dtype=np.float32)
+    starts = list(range(0, n, chunk_size))
+
+    def read_chunk(start):
+        # Each chunk is read from the (memory-mapped) embeddings only when it is submitted
+        if indices is None:
+            return np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        return np.asarray(embeddings[indices[start:start + chunk_size]], dtype=np.float32)
+
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_init_umap_worker,
+                             initargs=(model_file,)) as executor:
+        # Submit a bounded window of chunks so that only a few chunks are held in memory at once
+        for window in range(0, len(starts), 2 * n_workers):
+            window_starts = starts[window:window + 2 * n_workers]
+            futures = [executor.submit(_umap_transform_chunk, read_chunk(start))
+                       for start in window_starts]
+            for start, future in zip(window_starts, futures):
+                result[start:start + chunk_size] = future.result()
+            logging.info(f'\t\tProjected {min(n, window_starts[-1] + chunk_size)}/{n} embeddings')
+    return result
+
+def emb_2d_umap_sampled(ALL_EMBEDDINGS, n_neighbors, min_dist, n_fit=100000, model_file='umap_model.pkl',
+                        n_workers=4, chunk_size=20000, max_candidates=1000000):
+    # Fit UMAP on a sample and transform the rest, for embeddings too many to fit at once
+    model, fit_indices = fit_umap_on_sample(ALL_EMBEDDINGS, n_neighbors, min_dist,
+                                            n_fit=n_fit, model_file=model_file,
+                                            max_candidates=max_candidates, chunk_size=chunk_size)
+    result = np.zeros((ALL_EMBEDDINGS.shape[0], 2), dtype=np.float32)
+    result[fit_indices] = model.embedding_
+    rest_indices = np.setdiff1d(np.arange(ALL_EMBEDDINGS.shape[0]), fit_indices)
+    logging.info(f'\tProjecting the remaining {len(rest_indices)} embeddings...')
+    result[rest_indices] = transform_umap(model_file, ALL_EMBEDDINGS, indices=rest_indices,
+                                          n_workers=n_workers, chunk_size=chunk_size)
+    logging.info(f'\tProjecting the remaining {len(rest_indices)} embeddings...Done')
+    return result
+
 def run_hdbscan_clustering(coords_2d, min_cluster_size):
     model = HDBSCAN(min_cluster_size=min_cluster_size)
     model.fit(coords_2d)
     return model.labels_
 
-def run_leiden_clustering(coords_2d, n_neighbors=5, resolution=0.01):
-    nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1, 
-                            metric='cosine').fit(coords_2d)
-    distances, indices = nbrs.kneighbors(coords_2d)
+def run_leiden_clustering(coords_2d, n_neighbors=5, resolution=0.01, knn_index=None, seed=None):
+    if knn_index is not None:
+        indices, distances = knn_from_index(knn_index, n_neighbors + 1)
+    else:
+        nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1, 
+                                metric='cosine').fit(coords_2d)
+        distances, indices = nbrs.kneighbors(coords_2d)
 
-    edges = []
-    edge_weights = []
-    for i in range(coords_2d.shape[0]):
-        for j in range(1, n_neighbors + 1):
-            edges.append((i, indices[i][j]))
-            edge_weights.append(1 - distances[i][j])
+    # Build the weighted kNN graph with array operations.
+    # Symmetrizing with maximum merges the two directions of mutual neighbours into one edge.
+    n = indices.shape[0]
+    rows = np.repeat(np.arange(n), n_neighbors)
+    cols = indices[:, 1:n_neighbors + 1].ravel()
+    weights = 1 - distances[:, 1:n_neighbors + 1].ravel()
+    adjacency = coo_matrix((weights, (rows, cols)), shape=(n, n)).tocsr()
+    adjacency = adjacency.maximum(adjacency.T)
+    edges = triu(adjacency, k=1).tocoo()
 
-    g = igraph.Graph(edges=edges, directed=False)
-    g.es['weight'] = edge_weights
+    g = igraph.Graph(n=n, edges=np.column_stack([edges.row, edges.col]).tolist(), directed=False)
+    g.es['weight'] = edges.data.tolist()
 
     partition = leidenalg.find_partition(g, 
                                          leidenalg.CPMVertexPartition,
                                          weights='weight',
-                                         resolution_parameter=resolution)
+                                         resolution_parameter=resolution,
+                                         seed=seed)
     return np.array(partition.membership)
 
+def build_linkage(embeddings, backend='auto', n_neighbors=30, memory_limit=4 * 1024**3, knn_index=None):
+    """
+    Build an average-linkage (cosine) matrix for hierarchical clustering.
+
+    Parameters:
+        embeddings (np.array): The input embeddings of shape (num_samples, num_features).
+        backend (str): 'scipy' for the exact linkage on the dense condensed distance matrix,
+            'knn' for agglomeration restricted to a k-nearest-neighbour graph,
+            'auto' to use 'scipy' only if the condensed distance matrix fits in memory_limit.
+        n_neighbors (int): The number of neighbours of the kNN graph ('knn' backend).
+        memory_limit (int): The maximum size in bytes of the condensed distance matrix ('auto' backend).
+        knn_index (NNDescent): A prebuilt kNN index over the embeddings, used for the kNN graph if given.
+
+    Returns:
+        np.array: A linkage matrix in scipy format, which can be converted with to_tree.
+
+    The 'knn' backend computes neighbours in chunks on float32 vectors and only merges connected
+    clusters, so memory grows with num_samples * n_neighbors instead of num_samples^2.
+    """
+    n = embeddings.shape[0]
+    if backend == 'auto':
+        dense_bytes = n * (n - 1) // 2 * 8
+        backend = 'scipy' if dense_bytes <= memory_limit else 'knn'
+    logging.info(f'\tLinkage backend: {backend}')
+
+    if backend == 'scipy':
+        return linkage(embeddings,
+                       metric='cosine',
+                       method='average')
+
+    X = normalize_l2(np.asarray(embeddings, dtype=np.float32))
+    if knn_index is not None:
+        indices, _ = knn_from_index(knn_index, n_neighbors + 1)
+        rows = np.repeat(np.arange(n), indices.shape[1] - 1)
+        connectivity = csr_matrix((np.ones(rows.shape[0]), (rows, indices[:, 1:].ravel())),
+                                  shape=(n, n))
+    else:
+        connectivity = kneighbors_graph(X,
+                                        n_neighbors=min(n_neighbors, n - 1),
+                                        metric='cosine',
+                                        include_self=False)
+    model = AgglomerativeClustering(n_clusters=1,
+                                    metric='cosine',
+                                    linkage='average',
+                                    connectivity=connectivity,
+                                    compute_full_tree=True,
+                                    compute_distances=True)
+    model.fit(X)
+
+    # Convert sklearn's merge tree to scipy's linkage format
+    children = model.children_
+    counts = np.zeros(children.shape[0])
+    for i, (a, b) in enumerate(children):
+        counts[i] = (1 if a < n else counts[a - n]) + (1 if b < n else counts[b - n])
+    linkage_matrix = np.column_stack([children, model.distances_, counts]).astype(float)
+    return linkage_matrix
+
+def compute_leaf_ranges(tree, nodelist):
+    """
+    Precompute the leaves under every node of a linkage tree in one pass.
+
+    Parameters:
+        tree (ClusterNode): The root node returned by scipy's to_tree.
+        nodelist (list): The list of all nodes returned by to_tree(rd=True).
+
+    Returns:
+        tuple: (leaf_order, leaf_starts), where leaf_order is the left-to-right leaf ordering
+        and leaf_starts[node.id] is the position of the first leaf of the node in leaf_order,
+        so the members of a node are leaf_order[leaf_starts[node.id]:leaf_starts[node.id] + node.count].
+    """
+    leaf_order = np.array(tree.pre_order(), dtype=int)
+    leaf_starts = np.zeros(len(nodelist), dtype=int)
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.is_leaf():
+            continue
+        leaf_starts[node.left.id] = leaf_starts[node.id]
+        leaf_starts[node.right.id] = leaf_starts[node.id] + node.left.count
+        stack.append(node.left)
+        stack.append(node.right)
+    return leaf_order, leaf_starts
+
+def render_key_text(key_text):
+    return "Key: "+key_text['Key']+ \
+           "  Description: "+key_text['Description'] + \
+           "  Examples: "+str(key_text['Example_values'])
+
+def normalize_key_name(key):
+    return ''.join(c for c in str(key).lower() if c.isalnum())
+
+def estimate_purity(unit_embeddings, node_indices, node_height, key_names):
+    """
+    Estimate the purity of a node locally, without calling the LLM.
+
+    Parameters:
+        unit_embeddings (np.array): L2-normalized embeddings of all keys.
+        node_indices (list): The indices of the keys under the node.
+        node_height (float): The cophenetic height (merge distance) of the node.
+        key_names (list): Normalized key names of all keys.
+
+    Returns:
+        dict: 'Similarity' is the mean pairwise cosine similarity within the node,
+        'Height' is the cophenetic height, and 'Key_agreement' is the fraction of keys
+        sharing the most common normalized key name.
+    """
+    n = len(node_indices)
+    # Mean pairwise cosine similarity of unit vectors from the norm of their sum
+    vec_sum = unit_embeddings[node_indices].sum(axis=0, dtype=np.float64)
+    similarity = (float(vec_sum @ vec_sum) - n) / (n * (n - 1))
+    names = [key_names[i] for i in node_indices]
+    key_agreement = Counter(names).most_common(1)[0][1] / n
+    return {'Similarity': similarity,
+            'Height': float(node_height),
+            'Key_agreement': key_agreement}
+
+def purity_decision(estimate, auto_thresholds):
+    # 'split' for clearly impure nodes, 'accept' for clearly pure nodes, None for the LLM
+    if auto_thresholds is None:
+        return None
+    if estimate['Similarity'] < auto_thresholds['split_similarity']:
+        return 'split'
+    if estimate['Similarity'] >= auto_thresholds['accept_similarity'] and \
+        estimate['Height'] <= 1 - auto_thresholds['accept_similarity'] and \
+            estimate['Key_agreement'] >= auto_thresholds['accept_key_agreement']:
+        return 'accept'
+    return None
+
+def calibrate_purity_thresholds(records, purity_threshold, precision=0.95, min_support=10):
+    """
+    Calibrate the similarity thresholds of the purity shortcut from LLM-evaluated nodes.
+
+    Parameters:
+        records (list): Dicts with 'Similarity' and the LLM 'Purity' of evaluated nodes.
+        purity_threshold (float): The purity above which a node is considered pure.
+        precision (float): The required agreement with the LLM decisions.
+        min_support (int): The minimum number of nodes behind each threshold.
+
+    Returns:
+        dict: 'split_similarity' is the highest similarity below which at least `precision` of the
+        nodes were impure, and 'accept_similarity' the lowest similarity above which at least
+        `precision` of the nodes were pure (None if there is not enough evidence).
+    """
+    records = sorted(records, key=lambda r: r['Similarity'])
+    pure = [r['Purity'] >= purity_threshold for r in records]
+
+    split_similarity = None
+    n_impure = 0
+    for i, r in enumerate(records):
+        n_impure += not pure[i]
+        if i + 1 >= min_support and n_impure / (i + 1) >= precision:
+            split_similarity = r['Similarity']
+
+    accept_similarity = None
+    n_pure = 0
+    for i, r in enumerate(reversed(records)):
+        n_pure += pure[len(records) - 1 - i]
+        if i + 1 >= min_support and n_pure / (i + 1) >= precision:
+            accept_similarity = r['Similarity']
+
+    return {'split_similarity': split_similarity,
+            'accept_similarity': accept_similarity}
+
 def run_matching_keys(keys_embeddings, keys_texts, llm,
-                      purity_threshold=0.8, min_size=10):
+                      purity_threshold=0.8, min_size=10, n_workers=8,
+                      linkage_backend='auto', linkage_n_neighbors=30, linkage_memory_limit=4 * 1024**3,
+                      auto_thresholds=None, calibration_file=None, knn_index=None):
     logging.info('Running matching keys...')
     # Start hierarchical-clustering keys and convert linkage to a tree
-    linkage_matrix = linkage(keys_embeddings, 
-                             metric='cosine',
-                             method='average')
+    linkage_matrix = build_linkage(keys_embeddings,
+                                   backend=linkage_backend,
+                                   n_neighbors=linkage_n_neighbors,
+                                   memory_limit=linkage_memory_limit,
+                                   knn_index=knn_index)
     tree, nodelist = to_tree(linkage_matrix, rd=True)
+    leaf_order, leaf_starts = compute_leaf_ranges(tree, nodelist)
+
+    # Render key texts once up front
+    key_strings = [render_key_text(t) for t in keys_texts]
+    # For the local purity estimation
+    unit_embeddings = normalize_l2(np.asarray(keys_embeddings, dtype=np.float32))
+    key_names = [normalize_key_name(t['Key']) for t in keys_texts]
+    n_auto_split = 0
+    n_auto_accept = 0
+    calibration_records = []
+    # The local estimate is only needed by the shortcut or for calibration
+    use_estimate = auto_thresholds is not None or calibration_file is not None
 
-    # Queue for BFS, initialized with the root node
-    queue = deque([tree])
+    # BFS frontier, initialized with the root node.
+    # Nodes on the same tree level are independent, so their purity is
+    # calculated concurrently and the results are consumed in frontier order.
+    frontier = [tree]
     pure_clusters = []
 
-    while queue:
-        node = queue.popleft()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while frontier:
+            targets = []
+            next_frontier = []
+            for node in frontier:
+                # Leaves are not processed
+                if node.is_leaf():
+                    continue
+
+                if node.count < min_size:
+                    # Skip if the size is too small
+                    continue
 
-        # If node is not a leaf, process it
-        if not node.is_leaf():
-            # Collect indices of all items under this node
-            node_indices = []
-            leaf_queue = deque([node])
+                # Members of a node are a contiguous slice of the leaf order
+                node_indices = leaf_order[leaf_starts[node.id]:leaf_starts[node.id] + node.count].tolist()
 
-            # Traverse to collect all leaf indices under the current node
-            while leaf_queue:
-                current_node = leaf_queue.popleft()
-                if current_node.is_leaf():
-                    node_indices.append(current_node.id)
+                # Calculate purity if the size condition is met
+                current_texts = [key_strings[i] for i in node_indices]
+
+                # Skip the LLM for nodes that are clearly impure or clearly pure
+                estimate = estimate_purity(unit_embeddings, node_indices, node.dist, key_names) if use_estimate else {}
+                decision = purity_decision(estimate, auto_thresholds)
+                if decision == 'split':
+                    n_auto_split += 1
+                    next_frontier.append(node.left)
+                    next_frontier.append(node.right)
+                    continue
+                elif decision == 'accept':
+                    n_auto_accept += 1
+                    pure_clusters.append({'Indices':node_indices,
+                                          'Texts': current_texts,
+                                          'Purity': estimate['Similarity'],
+                                          'Estimated': True})
+                    continue
+
+                if len(current_texts) > 100:
+                    logging.info('\tDiversity-preserving sampling...')
+                    sampled_node_indices = sample_by_pca_clustering(keys_embeddings[node_indices, :], n_samples=100)
+                    query_texts = [current_texts[i] for i in sampled_node_indices]
+                    logging.info('\tDiversity-preserving sampling...Done.')
+                else:
+                    query_texts = current_texts
+                targets.append((node, node_indices, current_texts, query_texts, estimate))
+
+            logging.info(f'\tCalculating purity of {len(targets)} nodes...')
+            results = executor.map(lambda target: llm.calculate_purity(target[3]), targets)
+
+            for (node, node_indices, current_texts, _, estimate), result in zip(targets, results):
+                result = json.loads(result)
+                purity = float(result['Purity'])
+                logging.info(f'\tPurity calculation result: {result}')
+                calibration_records.append(dict(estimate, Purity=purity))
+
+                if purity < purity_threshold:
+                    next_frontier.append(node.left)
+                    next_frontier.append(node.right)
                 else:
-                    leaf_queue.append(current_node.left)
-                    leaf_queue.append(current_node.right)
-            
-            if len(node_indices) < min_size:
-                # Skip if the size is too small
-                continue
-
-            # Calculate purity if the size condition is met
-            current_texts = ["Key: "+keys_texts[i]['Key']+ \
-                             "  Description: "+keys_texts[i]['Description'] + \
-                             "  Examples: "+str(keys_texts[i]['Example_values'])
-                                for i in node_indices]
-            if len(current_texts) > 100:
-                logging.info('\tDiversity-preserving sampling...')
-                sampled_node_indices = sample_by_pca_clustering(keys_embeddings[node_indices, :], n_samples=100)
-                query_texts = [current_texts[i] for i in sampled_node_indices]
-                logging.info('\tDiversity-preserving sampling...Done.')
-            else:
-                query_texts = current_texts
-            result = llm.calculate_purity(query_texts)
-            result = json.loads(result)
-            purity = float(result['Purity'])
-            logging.info(f'\tPurity calculation result: {result}')
-            
-            if purity < purity_threshold:
-                queue.append(node.left)
-                queue.append(node.right)
-            else:
-                # If purity is high enough, do not explore further
-                pure_clusters.append({'Indices':node_indices,
-                                       'Texts': current_texts,
-                                       'Purity': purity})
+                    # If purity is high enough, do not explore further
+                    pure_clusters.append({'Indices':node_indices,
+                                           'Texts': current_texts,
+                                           'Purity': purity})
+            frontier = next_frontier
+
+    n_llm_calls = len(calibration_records)
+    logging.info(f'\tPurity LLM calls: {n_llm_calls}, '
+                 f'avoided: {n_auto_split + n_auto_accept} '
+                 f'(auto-split: {n_auto_split}, auto-accept: {n_auto_accept})')
+    if calibration_file is not None and auto_thresholds is not None:
+        # With the shortcut on, only the ambiguous nodes reach the LLM, which biases the calibration
+        logging.info('\tPurity calibration is skipped while the shortcut is on')
+    elif calibration_file is not None:
+        with open(calibration_file, 'w') as f:
+            json.dump(calibration_records, f)
+        calibrated = calibrate_purity_thresholds(calibration_records, purity_threshold)
+        logging.info(f'\tCalibrated purity shortcut thresholds: {calibrated}')
     
     logging.info('Running matching keys...Done.')
     return pure_clusters
 
+def compute_centroids(embeddings, cluster_indices, n_clusters):
+    # L2-normalized mean embedding of each cluster (zero vector for empty clusters)
+    unit_embeddings = normalize_l2(np.asarray(embeddings, dtype=np.float32))
+    centroids = np.zeros((n_clusters, unit_embeddings.shape[1]), dtype=np.float32)
+    valid = cluster_indices >= 0
+    np.add.at(centroids, cluster_indices[valid], unit_embeddings[valid])
+    return normalize_l2(centroids)
+
+def assign_to_clusters(embeddings, centroids, similarity_threshold=0.9):
+    """
+    Assign embeddings to the nearest existing cluster centroid.
+
+    Parameters:
+        embeddings (np.array): The embeddings to assign, of shape (num_samples, num_features).
+        centroids (np.array): L2-normalized cluster centroids, of shape (num_clusters, num_features).
+        similarity_threshold (float): The minimum cosine similarity to the nearest centroid.
+
+    Returns:
+        np.array: The cluster index of each embedding, or -1 if no centroid is similar enough.
+    """
+    nbrs = NearestNeighbors(n_neighbors=1,
+                            metric='cosine').fit(centroids)
+    distances, indices = nbrs.kneighbors(normalize_l2(np.asarray(embeddings, dtype=np.float32)))
+    return np.where(1 - distances[:, 0] >= similarity_threshold, indices[:, 0], -1)
+
 def sample_by_pca_clustering(data, n_samples=100, n_components=50, n_clusters=10):
     """
     Perform sampling from a dataset by reducing its dimensionality using PCA followed by clustering with K-Means. 
@@ -148,7 +627,10 @@ def sample_by_pca_clustering(data, n_samples=100, n_components=50, n_clusters=10
 
     kmeans = KMeans(n_clusters=n_clusters, random_state=0)
     clusters = kmeans.fit_predict(data_transformed)
+    return sample_from_clusters(clusters, n_samples=n_samples, n_clusters=n_clusters)
 
+def sample_from_clusters(clusters, n_samples=100, n_clusters=10):
+    # Sample uniformly from each cluster, and fill up with random samples if the clusters are small
     sample_indices = []
     for i in range(n_clusters):
         cluster_indices = np.where(clusters == i)[0]
@@ -160,7 +642,7 @@ def sample_by_pca_clustering(data, n_samples=100, n_components=50, n_clusters=10
     # 必要ならば残りのサンプルを追加サンプリング
     additional_samples_needed = n_samples - len(sample_indices)
     if additional_samples_needed > 0:
-        additional_indices = np.random.choice(range(data.shape[0]), additional_samples_needed, replace=False)
+        additional_indices = np.random.choice(range(len(clusters)), additional_samples_needed, replace=False)
         sample_indices.extend(additional_indices)
 
     return np.array(sample_indices)
@@ -20,6 +20,23 @@ class DevelopmentConfig:
     N_NEIGHBORS_KEYS = 50
     MIN_DIST_KEYS = 0.1
 
+    # Optional dimensionality reduction before clustering, per entity type:
+    # None or {'method': 'pca' | 'random_projection', 'n_components': int}
+    # (compare operating points with benchmark_reduction.py)
+    REDUCTION_PROJECT = None
+    REDUCTION_METHODS = None
+    REDUCTION_KEYS = None
+
+    # Fit UMAP of methods on a sample of this size and transform the rest (None to fit all)
+    UMAP_FIT_SAMPLE_METHODS = 200000
+    UMAP_FIT_MAX_CANDIDATES = 1000000  # random pool the diversity-preserving sample is drawn from
+    UMAP_TRANSFORM_WORKERS = 4
+    UMAP_TRANSFORM_CHUNK_SIZE = 20000
+
+    # Persistent approximate kNN index shared by UMAP, Leiden and the keys linkage
+    USE_KNN_INDEX = True
+    KNN_INDEX_N_NEIGHBORS = 64
+
     # CLUSTERING setting
     RESOLUTION_PROJECT = 0.01
     RESOLUTION_METHODS = 0.01
@@ -29,6 +46,22 @@ class DevelopmentConfig:
 
     KEYS_PURITY_THRESHOLD = 0.9
     KEYS_MIN_SIZE = 10
+    # Number of concurrent purity calculations per tree level
+    KEYS_PURITY_WORKERS = 8
+    # Hierarchical clustering of keys: 'scipy' (dense), 'knn' (kNN graph) or 'auto'
+    KEYS_LINKAGE_BACKEND = 'auto'
+    KEYS_LINKAGE_N_NEIGHBORS = 30
+    KEYS_LINKAGE_MEMORY_LIMIT = 4 * 1024**3  # 4GB
+    # Embedding-based purity shortcut (None to ask the LLM for every node).
+    # Only set it to the thresholds logged by a run with the shortcut off (calibrated from
+    # keys_purity_calibration.json), e.g. {'split_similarity': ..., 'accept_similarity': ..., 'accept_key_agreement': ...}
+    KEYS_AUTO_PURITY_THRESHOLDS = None
+    # Assign new keys to the clusters of the previous run instead of re-clustering all keys
+    KEYS_INCREMENTAL = False
+    KEYS_INCREMENTAL_SIMILARITY = 0.9
+
+    # Number of concurrent LLM summarizations of clusters
+    SUMMARY_WORKERS = 8
 
     DATA_DIR = '/Volumes/MDatahubDev/Total_result'
 
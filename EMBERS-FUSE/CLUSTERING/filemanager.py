@@ -1,47 +1,270 @@
 import os
 import glob
 import pickle
+import json
+import struct
+import hashlib
 import numpy as np
 import logging
 
+# Fixed-size .npy header, so the shape can be rewritten in place when rows are appended
+NPY_HEADER_SIZE = 128
+
+def write_npy_header(f, n_rows, dim):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (n_rows, dim)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+def load_embedding_npy(npy_file, n_rows=None):
+    # Open a float32 embedding matrix memory-mapped (read-only)
+    # If n_rows is given (the number of texts), the row count must match it
+    embeddings = np.load(npy_file, mmap_mode='r')
+    if n_rows is not None and embeddings.shape[0] != n_rows:
+        raise ValueError(f'{npy_file} has {embeddings.shape[0]} rows for {n_rows} texts')
+    if embeddings.dtype != np.float32:
+        # Convert a cache written by a previous version (float64) in chunks
+        logging.info(f'\tConverting {npy_file} to float32...')
+        writer = EmbeddingWriter(npy_file + '.tmp')
+        for start in range(0, embeddings.shape[0], writer.flush_rows):
+            writer.append(embeddings[start:start + writer.flush_rows])
+        del embeddings
+        writer.close(npy_file)
+        embeddings = np.load(npy_file, mmap_mode='r')
+    return embeddings
+
+class EmbeddingWriter():
+    ###
+    # 埋め込みベクトルをfloat32の.npyファイルに逐次追記するクラス
+    ###
+    def __init__(self, npy_file, flush_rows=10000, append=False, start_row=None):
+        self.npy_file = npy_file
+        self.flush_rows = flush_rows
+        self.append_mode = append
+        self.buffer = []
+        self.n_buffered = 0
+        self.n_rows = 0
+        self.dim = None
+        if append and os.path.exists(self.npy_file):
+            # Continue after the rows already written by EmbeddingWriter
+            existing = np.load(self.npy_file, mmap_mode='r')
+            self.n_rows, self.dim = existing.shape
+            del existing
+            if start_row is not None and start_row < self.n_rows:
+                # Drop the rows flushed by an interrupted run (not recorded in the manifest)
+                self.n_rows = start_row
+                with open(self.npy_file, 'r+b') as f:
+                    f.truncate(NPY_HEADER_SIZE + self.n_rows * self.dim * 4)
+                    write_npy_header(f, self.n_rows, self.dim)
+        elif os.path.exists(self.npy_file):
+            os.remove(self.npy_file)
+
+    @property
+    def total_rows(self):
+        return self.n_rows + self.n_buffered
+
+    def append(self, vecs):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if vecs.ndim == 1:
+            vecs = vecs[np.newaxis, :]
+        self.buffer.append(vecs)
+        self.n_buffered += vecs.shape[0]
+        if self.n_buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered == 0:
+            return
+        rows = np.ascontiguousarray(np.vstack(self.buffer), dtype=np.float32)
+        if self.dim is None:
+            self.dim = rows.shape[1]
+        mode = 'r+b' if os.path.exists(self.npy_file) else 'w+b'
+        with open(self.npy_file, mode) as f:
+            f.seek(NPY_HEADER_SIZE + self.n_rows * self.dim * 4)
+            f.write(rows.tobytes())
+            f.truncate()
+            self.n_rows += rows.shape[0]
+            write_npy_header(f, self.n_rows, self.dim)
+        self.buffer = []
+        self.n_buffered = 0
+
+    def close(self, final_file):
+        # Flush the remaining rows and move the file to its final path
+        self.flush()
+        if self.n_rows > 0:
+            os.replace(self.npy_file, final_file)
+
 class FileManager():
     def __init__(self, data_dir, out_dir):
         self.data_dir = data_dir
         self.out_dir = out_dir
+        # name -> fingerprint of the manifest of the last loaded aggregate
+        self.manifest_fingerprints = {}
 
-    def load_project(self):
-        logging.info('Loading project embedding and text files...')
-        project_embedding_file = os.path.join(self.out_dir, 'project_embedding.npy')
-        project_texts_file = os.path.join(self.out_dir, 'project_texts.pkl')
+    def read_project_pickle(self, PMC_ID, pkl_file):
+        data = pickle.load(open(pkl_file, 'rb'))
+        key_findings = data['key_findings']
+        if len(key_findings) == 0:
+            return [], [], {}
+        texts = [{'PMC_ID': PMC_ID, 
+                  'key_findings': key_findings}]
+        return texts, [data['embedding']], {}
+
+    def read_methods_pickle(self, PMC_ID, pkl_file):
+        # Row ranges of each section are relative to the first row of the PMC
+        data = pickle.load(open(pkl_file, 'rb'))
+        texts = []
+        vecs = []
+        sections = {}
+        emb_indices = 0
+        if len(data['Sampling']) != 0:
+            vec1 = data['Sampling_embedding']
+            sections['Sampling'] = [emb_indices, emb_indices + 1]
+            emb_indices += 1
+            vecs.append(vec1)
+            texts.append(f'{PMC_ID} Sampling: '+data['Sampling'])
+
+        if len(data['DNAExtraction']) != 0:
+            vecs2 = data['DNAExtraction_embedding']
+            if vecs2.ndim == 1:
+                len_vecs2 = 1
+            else:
+                len_vecs2 = vecs2.shape[0]
+            sections['DNAExtraction'] = [emb_indices, emb_indices + len_vecs2]
+            emb_indices += len_vecs2
+            vecs.append(vecs2)
+            texts.extend([f'{PMC_ID} DNA Extraction: '+de for de in data['DNAExtraction']])
+        return texts, vecs, sections
 
-        if os.path.exists(project_embedding_file) and \
-            os.path.exists(project_texts_file):
-            all_texts = pickle.load(open(project_texts_file, 'rb'))
-            all_embeddings = np.load(project_embedding_file)
+    def read_keys_pickle(self, PMC_ID, pkl_file):
+        data = pickle.load(open(pkl_file, 'rb'))
+        texts = []
+        vecs = []
+        for d in data:
+            texts.append({'PMC_ID': PMC_ID, 
+                          'Key': d['Key'],
+                          'Description': d['Description'],
+                          'Example_values': d['Example_values']})
+            vecs.append(d['Embedding'])
+        return texts, vecs, {}
+
+    def scan_embedding_pickles(self, pattern):
+        pickles = {}
+        for pkl_file in glob.glob(os.path.join(self.data_dir, pattern)):
+            PMC_ID = os.path.basename(pkl_file).split('_')[0]
+            stat = os.stat(pkl_file)
+            pickles[PMC_ID] = {'file': pkl_file,
+                               'mtime': stat.st_mtime,
+                               'size': stat.st_size}
+        return pickles
+
+    def load_aggregate(self, name, pattern, reader):
+        ###
+        # PMC*/PMC*_{name}_embedding.pklを集約した埋め込み行列とテキストを読み込む
+        # manifest (PMC -> pklのmtime/size, 行範囲) を使って、追加・変更・削除されたPMCの分だけ更新する
+        ###
+        embedding_file = os.path.join(self.out_dir, f'{name}_embedding.npy')
+        texts_file = os.path.join(self.out_dir, f'{name}_texts.pkl')
+        manifest_file = os.path.join(self.out_dir, f'{name}_manifest.pkl')
+
+        current = self.scan_embedding_pickles(pattern)
+        all_texts = []
+        manifest = {}
+        all_embeddings = None
+        if os.path.exists(embedding_file) and \
+            os.path.exists(texts_file) and \
+                os.path.exists(manifest_file):
+            all_texts = pickle.load(open(texts_file, 'rb'))
+            manifest = pickle.load(open(manifest_file, 'rb'))
+            all_embeddings = load_embedding_npy(embedding_file)
+            n_rows = max([entry['end'] for entry in manifest.values()], default=0)
+            # Rows past the manifest were flushed by an interrupted run and are dropped below;
+            # fewer rows or texts than the manifest means the cache is inconsistent
+            if len(all_texts) != n_rows or all_embeddings.shape[0] < n_rows:
+                logging.info(f'\t{name} embedding cache is inconsistent; rebuilding')
+                all_texts = []
+                manifest = {}
+                all_embeddings = None
+
+        unchanged = [PMC_ID for PMC_ID, entry in manifest.items()
+                     if PMC_ID in current and \
+                        current[PMC_ID]['mtime'] == entry['mtime'] and \
+                            current[PMC_ID]['size'] == entry['size']]
+        unchanged_set = set(unchanged)
+        added = sorted(PMC_ID for PMC_ID in current if PMC_ID not in unchanged_set)
+        removed = [PMC_ID for PMC_ID in manifest if PMC_ID not in unchanged_set]
+
+        if len(added) == 0 and len(removed) == 0 and \
+            (all_embeddings is None or all_embeddings.shape[0] == len(all_texts)):
+            if all_embeddings is None:
+                return None, None, None
+            self.manifest_fingerprints[name] = self.manifest_fingerprint(manifest)
+            return all_texts, all_embeddings, manifest
+        logging.info(f'\tUpdating {name} embeddings: {len(added)} new or changed PMCs, '
+                     f'{len(removed)} changed or removed PMCs')
+
+        if len(removed) == 0 and \
+            all_embeddings is not None and \
+                all_embeddings.offset == NPY_HEADER_SIZE:
+            # Only additions: append the new rows after the rows recorded in the manifest
+            del all_embeddings
+            writer = EmbeddingWriter(embedding_file, append=True, start_row=len(all_texts))
         else:
-            all_texts = []
-            all_embeddings = []
-            for pkl_file in glob.glob(os.path.join(self.data_dir, 'PMC*/PMC*_project_embedding.pkl')):
-                data = pickle.load(open(pkl_file, 'rb'))
-                PMC_ID = os.path.basename(pkl_file).split('_')[0]
-                key_findings = data['key_findings']
-
-                if len(key_findings) == 0:
-                    continue
-
-                all_texts.append({'PMC_ID': PMC_ID, 
-                                  'key_findings': key_findings})
-                vec = data['embedding']
-                all_embeddings.append(vec)
-
-            if len(all_embeddings) == 0:
-                logging.error('No project embedding files')
-                return None, None
-            all_embeddings = np.vstack(all_embeddings)
-            
-            np.save(project_embedding_file, all_embeddings)
-            with open(project_texts_file, 'wb') as f:
-                pickle.dump(all_texts, f)
+            # Copy the rows of the unchanged PMCs into a new file
+            writer = EmbeddingWriter(embedding_file + '.tmp')
+            new_texts = []
+            new_manifest = {}
+            for PMC_ID in sorted(unchanged, key=lambda pmc: manifest[pmc]['start']):
+                entry = manifest[PMC_ID]
+                start = writer.total_rows
+                if entry['end'] > entry['start']:
+                    writer.append(all_embeddings[entry['start']:entry['end']])
+                new_texts.extend(all_texts[entry['start']:entry['end']])
+                new_manifest[PMC_ID] = dict(entry, start=start, end=writer.total_rows)
+            all_texts = new_texts
+            manifest = new_manifest
+
+        for PMC_ID in added:
+            texts, vecs, extra = reader(PMC_ID, current[PMC_ID]['file'])
+            start = writer.total_rows
+            for vec in vecs:
+                writer.append(vec)
+            all_texts.extend(texts)
+            manifest[PMC_ID] = {'mtime': current[PMC_ID]['mtime'],
+                                'size': current[PMC_ID]['size'],
+                                'start': start,
+                                'end': writer.total_rows,
+                                'extra': extra}
+
+        if writer.append_mode:
+            writer.flush()
+        else:
+            writer.close(embedding_file)
+        if writer.n_rows == 0:
+            return None, None, None
+        all_embeddings = load_embedding_npy(embedding_file, n_rows=len(all_texts))
+
+        for out_file, data in [(texts_file, all_texts), (manifest_file, manifest)]:
+            with open(out_file + '.tmp', 'wb') as f:
+                pickle.dump(data, f)
+            os.replace(out_file + '.tmp', out_file)
+        self.manifest_fingerprints[name] = self.manifest_fingerprint(manifest)
+        return all_texts, all_embeddings, manifest
+
+    def manifest_fingerprint(self, manifest):
+        # Fingerprint of the PMC files and row ranges an aggregate was built from
+        entries = sorted([PMC_ID, entry['mtime'], entry['size'], entry['start'], entry['end']]
+                         for PMC_ID, entry in manifest.items())
+        return hashlib.md5(json.dumps(entries).encode()).hexdigest()
+
+    def load_project(self):
+        logging.info('Loading project embedding and text files...')
+        all_texts, all_embeddings, _ = self.load_aggregate('project',
+                                                           'PMC*/PMC*_project_embedding.pkl',
+                                                           self.read_project_pickle)
+        if all_embeddings is None:
+            logging.error('No project embedding files')
+            return None, None
             
         logging.info('Loading project embedding and text files...Done')
         logging.info(f'\tProject embeddings shape: {all_embeddings.shape}')
@@ -49,88 +272,131 @@ class FileManager():
     
     def load_methods(self):
         logging.info('Loading methods embedding and text files...')
-        methods_embedding_file = os.path.join(self.out_dir, 'methods_embedding.npy')
         methods_indices_file = os.path.join(self.out_dir, 'methods_indices.pkl')
-        methods_texts_file = os.path.join(self.out_dir, 'methods_texts.pkl')
-
-        if os.path.exists(methods_embedding_file) and \
-            os.path.exists(methods_indices_file) and \
-                os.path.exists(methods_texts_file):
-            all_methods_indices = pickle.load(open(methods_indices_file, 'rb'))
-            all_texts = pickle.load(open(methods_texts_file, 'rb'))
-            all_embeddings = np.load(methods_embedding_file)
-        else:
-            all_methods_indices = {}
-            all_texts = []
-            all_embeddings = []
-            emb_indices = 0
-            for pkl_file in glob.glob(os.path.join(self.data_dir, 'PMC*/PMC*_methods_embedding.pkl')):
-                data = pickle.load(open(pkl_file, 'rb'))
-                PMC_ID = os.path.basename(pkl_file).split('_')[0]
-                all_methods_indices[PMC_ID] = {}
-                if len(data['Sampling']) != 0:
-                    vec1 = data['Sampling_embedding']
-                    all_methods_indices[PMC_ID]['Sampling'] = [emb_indices, emb_indices + 1]
-                    emb_indices += 1
-                    all_embeddings.append(vec1)
-                    all_texts.append(f'{PMC_ID} Sampling: '+data['Sampling'])
-                
-                if len(data['DNAExtraction']) != 0:
-                    vecs2 = data['DNAExtraction_embedding']
-                    if vecs2.ndim == 1:
-                        len_vecs2 = 1
-                    else:
-                        len_vecs2 = vecs2.shape[0]
-                    all_methods_indices[PMC_ID]['DNAExtraction'] = [emb_indices, emb_indices + len_vecs2]
-                    emb_indices += len_vecs2
-                    all_embeddings.append(vecs2)
-                    all_texts.extend([f'{PMC_ID} DNA Extraction: '+de for de in data['DNAExtraction']])
-
-            if len(all_embeddings) == 0:
-                logging.error('No methods embedding files')
-                return None, None, None
-            all_embeddings = np.vstack(all_embeddings)
-            
-            np.save(methods_embedding_file, all_embeddings)
-            with open(methods_indices_file, 'wb') as f:
-                pickle.dump(all_methods_indices, f)
-            with open(methods_texts_file, 'wb') as f:
-                pickle.dump(all_texts, f)
+        all_texts, all_embeddings, manifest = self.load_aggregate('methods',
+                                                                  'PMC*/PMC*_methods_embedding.pkl',
+                                                                  self.read_methods_pickle)
+        if all_embeddings is None:
+            logging.error('No methods embedding files')
+            return None, None, None
+
+        all_methods_indices = {}
+        for PMC_ID, entry in manifest.items():
+            all_methods_indices[PMC_ID] = {section: [entry['start'] + r[0], entry['start'] + r[1]]
+                                           for section, r in entry['extra'].items()}
+        with open(methods_indices_file, 'wb') as f:
+            pickle.dump(all_methods_indices, f)
 
         logging.info('Loading methods embedding and text files...Done')
         return all_texts, all_embeddings, all_methods_indices
     
     def load_keys(self):
         logging.info('Loading keys embedding and text files...')
-        keys_embedding_file = os.path.join(self.out_dir, 'keys_embedding.npy')
-        key_texts_file = os.path.join(self.out_dir, 'keys_texts.pkl')
-
-        if os.path.exists(keys_embedding_file) and \
-            os.path.exists(key_texts_file):
-            all_texts = pickle.load(open(key_texts_file, 'rb'))
-            all_embeddings = np.load(keys_embedding_file)
-        else:
-            all_texts = []
-            all_embeddings = []
-            for pkl_file in glob.glob(os.path.join(self.data_dir, 'PMC*/PMC*_new_keys_descriptions_embedding.pkl')):
-                data = pickle.load(open(pkl_file, 'rb'))
-                PMC_ID = os.path.basename(pkl_file).split('_')[0]
-                for d in data:
-                    all_texts.append({'PMC_ID': PMC_ID, 
-                                    'Key': d['Key'],
-                                    'Description': d['Description'],
-                                    'Example_values': d['Example_values']})
-                    vec = d['Embedding']
-                    all_embeddings.append(vec)
-
-            if len(all_embeddings) == 0:
-                logging.error('No keys embedding files')
-                return None, None
-            all_embeddings = np.vstack(all_embeddings)
-            
-            np.save(keys_embedding_file, all_embeddings)
-            with open(key_texts_file, 'wb') as f:
-                pickle.dump(all_texts, f)
+        all_texts, all_embeddings, _ = self.load_aggregate('keys',
+                                                           'PMC*/PMC*_new_keys_descriptions_embedding.pkl',
+                                                           self.read_keys_pickle)
+        if all_embeddings is None:
+            logging.error('No keys embedding files')
+            return None, None
         
         logging.info('Loading keys embedding and text files...Done')
-        return all_texts, all_embeddings
\ No newline at end of file
+        return all_texts, all_embeddings
+
+    def embeddings_fingerprint(self, embeddings):
+        # Cheap fingerprint to detect whether an index was built from the same embeddings
+        step = max(1, embeddings.shape[0] // 1000)
+        return (embeddings.shape, float(np.asarray(embeddings[::step], dtype=np.float64).sum()))
+
+    def load_knn_index(self, name, embeddings, n_neighbors):
+        knn_index_file = os.path.join(self.out_dir, f'{name}_knn_index.pkl')
+        if not os.path.exists(knn_index_file):
+            return None
+        with open(knn_index_file, 'rb') as f:
+            data = pickle.load(f)
+        if data['fingerprint'] != self.embeddings_fingerprint(embeddings) or \
+            data['n_neighbors'] < n_neighbors:
+            logging.info(f'\t{name} kNN index is outdated')
+            return None
+        logging.info(f'\tLoaded {name} kNN index')
+        return data['index']
+
+    def write_knn_index(self, name, embeddings, knn_index, n_neighbors):
+        knn_index_file = os.path.join(self.out_dir, f'{name}_knn_index.pkl')
+        with open(knn_index_file, 'wb') as f:
+            pickle.dump({'fingerprint': self.embeddings_fingerprint(embeddings),
+                         'n_neighbors': n_neighbors,
+                         'index': knn_index}, f)
+
+    def load_reducer(self, name, method, n_components, input_dim):
+        # The reducer is fitted once and reused as embeddings are added, so that
+        # clustering results of earlier runs (e.g. keys centroids) stay in the same space
+        reducer_file = os.path.join(self.out_dir, f'{name}_reducer.pkl')
+        # Returns (reducer, fingerprint); the fingerprint identifies the fitted reducer
+        if not os.path.exists(reducer_file):
+            return None, None
+        with open(reducer_file, 'rb') as f:
+            data = pickle.load(f)
+        if data['method'] != method or \
+            data['n_components'] != n_components or \
+                data['input_dim'] != input_dim:
+            logging.info(f'\t{name} reducer does not match the configuration')
+            return None, None
+        logging.info(f'\tLoaded {name} reducer')
+        return data['reducer'], data.get('fingerprint')
+
+    def write_reducer(self, name, method, n_components, input_dim, reducer):
+        reducer_file = os.path.join(self.out_dir, f'{name}_reducer.pkl')
+        fingerprint = hashlib.md5(pickle.dumps(reducer)).hexdigest()
+        with open(reducer_file, 'wb') as f:
+            pickle.dump({'method': method,
+                         'n_components': n_components,
+                         'input_dim': input_dim,
+                         'fingerprint': fingerprint,
+                         'reducer': reducer}, f)
+        return fingerprint
+
+    def load_keys_clustering(self):
+        # Clustering result of the previous keys run (None if not available)
+        cluster_indices_file = os.path.join(self.out_dir, 'keys_cluster_indices.npy')
+        centroids_file = os.path.join(self.out_dir, 'keys_cluster_centroids.npy')
+        members_file = os.path.join(self.out_dir, 'keys_cluster_members.pkl')
+        meta_file = os.path.join(self.out_dir, 'keys_cluster_meta.json')
+        labels_descriptions_file = os.path.join(self.out_dir, 'keys_labels_descriptions.json')
+
+        if not (os.path.exists(cluster_indices_file) and \
+            os.path.exists(centroids_file) and \
+                os.path.exists(members_file)):
+            logging.info('No previous keys clustering result')
+            return None
+
+        previous = {}
+        # Embedding space of the centroids and the clustering the labels belong to
+        # (None for results written before they were recorded)
+        previous['meta'] = json.load(open(meta_file, 'r')) if os.path.exists(meta_file) else None
+        previous['cluster_indices'] = np.load(cluster_indices_file)
+        previous['centroids'] = np.load(centroids_file)
+        previous['members'] = pickle.load(open(members_file, 'rb'))
+        if os.path.exists(labels_descriptions_file):
+            previous['labels_descriptions'] = json.load(open(labels_descriptions_file, 'r'))
+        else:
+            previous['labels_descriptions'] = None
+        return previous
+
+    def write_keys_clustering(self, cluster_indices, centroids, members, meta):
+        # The meta file records the embedding space (reduction) of the centroids
+        np.save(os.path.join(self.out_dir, 'keys_cluster_indices.npy'), cluster_indices)
+        np.save(os.path.join(self.out_dir, 'keys_cluster_centroids.npy'), centroids)
+        with open(os.path.join(self.out_dir, 'keys_cluster_members.pkl'), 'wb') as f:
+            pickle.dump(members, f)
+        with open(os.path.join(self.out_dir, 'keys_cluster_meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+    def write_keys_labels_descriptions(self, labels_descriptions, clustering_id):
+        # The meta file records which clustering the descriptions belong to (list position = cluster index)
+        with open(os.path.join(self.out_dir, 'keys_labels_descriptions.json'), 'w') as f:
+            json.dump(labels_descriptions, f)
+        meta_file = os.path.join(self.out_dir, 'keys_cluster_meta.json')
+        meta = json.load(open(meta_file, 'r')) if os.path.exists(meta_file) else {}
+        meta['Labels_clustering_id'] = clustering_id
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f, indent=4)
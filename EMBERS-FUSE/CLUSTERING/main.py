@@ -3,7 +3,9 @@ import json
 import pickle
 import logging
 import datetime
+import hashlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import Config
 from llm import LLM
 from filemanager import FileManager
@@ -16,6 +18,127 @@ class RunCluster():
     def __init__(self, llm, filemanager):
         self.llm = llm
         self.files = filemanager
+        # Embedding space (reduction) of the last embeddings passed to reduce, per entity
+        self.embedding_spaces = {}
+
+    def knn_index(self, name, embs):
+        # Load the persistent kNN index of the embeddings, or build and save it
+        if not Config.USE_KNN_INDEX:
+            return None
+        knn_index = self.files.load_knn_index(name, embs, Config.KNN_INDEX_N_NEIGHBORS)
+        if knn_index is None:
+            knn_index = cluster.build_knn_index(embs, n_neighbors=Config.KNN_INDEX_N_NEIGHBORS)
+            self.files.write_knn_index(name, embs, knn_index, Config.KNN_INDEX_N_NEIGHBORS)
+        return knn_index
+
+    def reduce(self, name, embs, reduction):
+        # Reduce dimensionality with the cached reducer of the entity, fitting it on first use
+        if reduction is None:
+            self.embedding_spaces[name] = {'Method': None, 'Input_dim': embs.shape[1]}
+            return embs
+        reducer, fingerprint = self.files.load_reducer(name, reduction['method'], reduction['n_components'], embs.shape[1])
+        if reducer is None:
+            logging.info(f'\tFitting {name} reducer...')
+            reducer = cluster.fit_reducer(embs, method=reduction['method'], n_components=reduction['n_components'])
+            fingerprint = self.files.write_reducer(name, reduction['method'], reduction['n_components'], embs.shape[1], reducer)
+            logging.info(f'\tFitting {name} reducer...Done')
+        self.embedding_spaces[name] = {'Method': reduction['method'],
+                                       'N_components': reduction['n_components'],
+                                       'Input_dim': embs.shape[1],
+                                       'Fingerprint': fingerprint}
+        embs = cluster.reduce_embeddings(embs, reducer)
+        logging.info(f'\t\tReduced {name} embeddings to {embs.shape[1]} dimensions')
+        return embs
+
+    def summary_progress_file(self, name):
+        return os.path.join(Config.OUT_DIR, f'{name}_summary_progress.jsonl')
+
+    def clusters_signature(self, cluster_indices):
+        return hashlib.md5(np.ascontiguousarray(cluster_indices, dtype=np.int64).tobytes()).hexdigest()
+
+    def read_progress_header(self, line):
+        # Header of a progress file; None if it is empty or partially written (not resumable)
+        try:
+            header = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(header, dict) or 'Signature' not in header or 'Reused' not in header or \
+            'Data' not in header:
+            return None
+        return header
+
+    def progress_data(self, name, texts):
+        # Texts and embeddings a summarization runs on; a progress file is resumed only on the same data
+        return {'N_texts': len(texts), 'Manifest': self.files.manifest_fingerprints.get(name)}
+
+    def load_unfinished_summary(self, name, data):
+        # Cluster indices and progress header of an interrupted summarization on the same data
+        # (None if there is none)
+        progress_file = self.summary_progress_file(name)
+        cluster_indices_file = os.path.join(Config.OUT_DIR, f'{name}_cluster_indices.npy')
+        if not os.path.exists(progress_file) or \
+            not os.path.exists(cluster_indices_file):
+            return None, None
+        cluster_indices = np.load(cluster_indices_file)
+        with open(progress_file, 'r') as f:
+            header = self.read_progress_header(f.readline())
+        if header is None or header['Data'] != data or \
+            header['Signature'] != self.clusters_signature(cluster_indices):
+            return None, None
+        logging.info(f'\tResuming interrupted summarization of {name} clusters')
+        return cluster_indices, header
+
+    def summarize_clusters(self, name, cluster_indices, cluster_ids, summarize, data, reused=[]):
+        ###
+        # クラスタごとのLLM要約を並列に実行し、cluster_idsの順に結果を返す
+        # 完了した要約は逐次progressファイルに書き出し、中断しても再開できるようにする
+        ###
+        progress_file = self.summary_progress_file(name)
+        signature = self.clusters_signature(cluster_indices)
+
+        completed = {}
+        if os.path.exists(progress_file):
+            with open(progress_file, 'r') as f:
+                lines = f.readlines()
+            header = self.read_progress_header(lines[0]) if len(lines) > 0 else None
+            if header is not None and header['Signature'] == signature and header['Data'] == data:
+                for line in lines[1:]:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written last line
+                        continue
+                    completed[record['Cluster']] = record['Result']
+            else:
+                os.remove(progress_file)
+        if not os.path.exists(progress_file):
+            with open(progress_file, 'w') as f:
+                f.write(json.dumps({'Signature': signature, 'Data': data, 'Reused': reused}) + '\n')
+
+        pending = [cid for cid in cluster_ids if cid not in completed]
+        logging.info(f'\t\tAlready summarized: {len(completed)}, remaining: {len(pending)}')
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=Config.SUMMARY_WORKERS) as executor, \
+            open(progress_file, 'a') as f:
+            futures = {executor.submit(summarize, cid): cid for cid in pending}
+            for future in as_completed(futures):
+                cid = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f'\tCluster{cid}: {e}')
+                    failed.append(cid)
+                    continue
+                f.write(json.dumps({'Cluster': cid, 'Result': result}) + '\n')
+                f.flush()
+                completed[cid] = result
+                logging.info(f'\tCluster{cid}: {result}')
+        if len(failed) > 0:
+            raise RuntimeError(f'Failed to summarize {name} clusters {sorted(failed)}. Run again to resume.')
+
+        os.remove(progress_file)
+        return [completed[cid] for cid in cluster_ids]
     
     def run_project(self, with_llm_summary=False):
         logging.info('Start clustering project')
@@ -26,32 +149,38 @@ class RunCluster():
             return
         logging.info(f'\tProject embeddings shape: {project_embs.shape}')
         
-        logging.info('\tNormalize and reduce dimensionality of project embeddings...')
-        project_embs = cluster.normalize_l2(project_embs[:, :Config.EMB_DIM_PROJECT])
-        coords_2d = cluster.emb_2d_umap(project_embs, 
-                                        n_neighbors=Config.N_NEIGHBORS_PROJECT, 
-                                        min_dist=Config.MIN_DIST_PROJECT)
-        np.save(os.path.join(Config.OUT_DIR, 'project_coords.npy'), coords_2d)
-        logging.info('\tNormalize and reduce dimensionality of project embeddings...Done')
-        
-        logging.info('\tClustering project embeddings...')
-        cluster_indices = cluster.run_hdbscan_clustering(coords_2d,
-                                                         min_cluster_size=Config.MIN_CLUSTER_SIZE_PROJECT)
-        np.save(os.path.join(Config.OUT_DIR, 'project_cluster_indices.npy'), cluster_indices)
-        logging.info(f'\t\tNumber of clusters: {cluster_indices.max()+1}')
-        logging.info('\tClustering project embeddings...Done')
+        progress_data = self.progress_data('project', project_texts)
+        cluster_indices, _ = self.load_unfinished_summary('project', progress_data) if with_llm_summary else (None, None)
+        if cluster_indices is None:
+            logging.info('\tNormalize and reduce dimensionality of project embeddings...')
+            project_embs = cluster.normalize_l2_chunked(project_embs, dim=Config.EMB_DIM_PROJECT)
+            project_embs = self.reduce('project', project_embs, Config.REDUCTION_PROJECT)
+            coords_2d = cluster.emb_2d_umap(project_embs, 
+                                            n_neighbors=Config.N_NEIGHBORS_PROJECT, 
+                                            min_dist=Config.MIN_DIST_PROJECT,
+                                            knn_index=self.knn_index('project', project_embs))
+            np.save(os.path.join(Config.OUT_DIR, 'project_coords.npy'), coords_2d)
+            logging.info('\tNormalize and reduce dimensionality of project embeddings...Done')
+            
+            logging.info('\tClustering project embeddings...')
+            cluster_indices = cluster.run_hdbscan_clustering(coords_2d,
+                                                             min_cluster_size=Config.MIN_CLUSTER_SIZE_PROJECT)
+            np.save(os.path.join(Config.OUT_DIR, 'project_cluster_indices.npy'), cluster_indices)
+            logging.info(f'\t\tNumber of clusters: {cluster_indices.max()+1}')
+            logging.info('\tClustering project embeddings...Done')
 
         if with_llm_summary:
             logging.info('\tSummarizing clustering results...')
             project_labels = ['Unlabelled'] * project_embs.shape[0]
-            for cluster_id in range(cluster_indices.max()+1):
+            def summarize(cluster_id):
                 project_indices = np.where(cluster_indices == cluster_id)[0]
                 project_texts_cluster = [project_texts[i]['key_findings'] for i in project_indices]
-                result = self.llm.summarize_project_findings(project_texts_cluster)
-                result = json.loads(result)
-                for idx in project_indices:
+                return json.loads(self.llm.summarize_project_findings(project_texts_cluster))
+            cluster_ids = list(range(cluster_indices.max()+1))
+            results = self.summarize_clusters('project', cluster_indices, cluster_ids, summarize, progress_data)
+            for cluster_id, result in zip(cluster_ids, results):
+                for idx in np.where(cluster_indices == cluster_id)[0]:
                     project_labels[idx] = result['Topic']
-                logging.info(f'\tCluster{cluster_id}: {result}')
             with open(os.path.join(Config.OUT_DIR, 'project_labels.pkl'), 'wb') as f:
                 pickle.dump(project_labels, f)
             logging.info('\tSummarizing clustering results...Done')
@@ -75,33 +204,51 @@ class RunCluster():
             return
         logging.info(f'\tMethods embeddings shape: {methods_embs.shape}')
 
-        logging.info('\tNormalize and reduce dimensionality of methods embeddings...')
-        methods_embs = cluster.normalize_l2(methods_embs[:, :Config.EMB_DIM_METHODS])
-        coords_2d = cluster.emb_2d_umap(methods_embs,
-                                        n_neighbors=Config.N_NEIGHBORS_METHODS,
-                                        min_dist=Config.MIN_DIST_METHODS)
-        np.save(os.path.join(Config.OUT_DIR, 'methods_coords.npy'), coords_2d)
-        logging.info('\tNormalize and reduce dimensionality of methods embeddings...Done')
-
-        logging.info('\tClustering methods embeddings...')
-        cluster_indices = cluster.run_hdbscan_clustering(coords_2d,
-                                                         min_cluster_size=Config.MIN_CLUSTER_SIZE_METHODS)
-        np.save(os.path.join(Config.OUT_DIR, 'methods_cluster_indices.npy'), cluster_indices)
-        logging.info(f'\t\tNumber of clusters: {cluster_indices.max()+1}')
-        logging.info('\tClustering methods embeddings...Done')
+        progress_data = self.progress_data('methods', methods_texts)
+        cluster_indices, _ = self.load_unfinished_summary('methods', progress_data) if with_llm_summary else (None, None)
+        if cluster_indices is None:
+            logging.info('\tNormalize and reduce dimensionality of methods embeddings...')
+            methods_embs = cluster.normalize_l2_chunked(methods_embs, dim=Config.EMB_DIM_METHODS)
+            methods_embs = self.reduce('methods', methods_embs, Config.REDUCTION_METHODS)
+            if Config.UMAP_FIT_SAMPLE_METHODS is not None and \
+                methods_embs.shape[0] > Config.UMAP_FIT_SAMPLE_METHODS:
+                # Fit on a diversity-preserving sample and transform the rest
+                coords_2d = cluster.emb_2d_umap_sampled(methods_embs,
+                                                        n_neighbors=Config.N_NEIGHBORS_METHODS,
+                                                        min_dist=Config.MIN_DIST_METHODS,
+                                                        n_fit=Config.UMAP_FIT_SAMPLE_METHODS,
+                                                        model_file=os.path.join(Config.OUT_DIR, 'methods_umap_model.pkl'),
+                                                        n_workers=Config.UMAP_TRANSFORM_WORKERS,
+                                                        chunk_size=Config.UMAP_TRANSFORM_CHUNK_SIZE,
+                                                        max_candidates=Config.UMAP_FIT_MAX_CANDIDATES)
+            else:
+                coords_2d = cluster.emb_2d_umap(methods_embs,
+                                                n_neighbors=Config.N_NEIGHBORS_METHODS,
+                                                min_dist=Config.MIN_DIST_METHODS,
+                                                knn_index=self.knn_index('methods', methods_embs))
+            np.save(os.path.join(Config.OUT_DIR, 'methods_coords.npy'), coords_2d)
+            logging.info('\tNormalize and reduce dimensionality of methods embeddings...Done')
+
+            logging.info('\tClustering methods embeddings...')
+            cluster_indices = cluster.run_hdbscan_clustering(coords_2d,
+                                                             min_cluster_size=Config.MIN_CLUSTER_SIZE_METHODS)
+            np.save(os.path.join(Config.OUT_DIR, 'methods_cluster_indices.npy'), cluster_indices)
+            logging.info(f'\t\tNumber of clusters: {cluster_indices.max()+1}')
+            logging.info('\tClustering methods embeddings...Done')
 
         if with_llm_summary:
             logging.info('\tSummarizing clustering results...')
             methods_labels = ['Unlabelled'] * methods_embs.shape[0]
-            for cluster_id in range(cluster_indices.max()+1):
+            def summarize(cluster_id):
                 methods_indices_cluster = np.where(cluster_indices == cluster_id)[0]
                 methods_texts_cluster = [methods_texts[i] for i in methods_indices_cluster]
                 # Using only 100 first texts for summarization
-                result = self.llm.summarize_methods(methods_texts_cluster[:100])
-                result = json.loads(result)
-                for idx in methods_indices_cluster:
+                return json.loads(self.llm.summarize_methods(methods_texts_cluster[:100]))
+            cluster_ids = list(range(cluster_indices.max()+1))
+            results = self.summarize_clusters('methods', cluster_indices, cluster_ids, summarize, progress_data)
+            for cluster_id, result in zip(cluster_ids, results):
+                for idx in np.where(cluster_indices == cluster_id)[0]:
                     methods_labels[idx] = result['Label']
-                logging.info(f'\tCluster{cluster_id}: {result}')
             with open(os.path.join(Config.OUT_DIR, 'methods_labels.pkl'), 'wb') as f:
                 pickle.dump(methods_labels, f)
             logging.info('\tSummarizing clustering results...Done')
@@ -115,7 +262,7 @@ class RunCluster():
 
         logging.info('End clustering methods')
 
-    def run_keys(self, with_llm_summary=False):
+    def run_keys(self, with_llm_summary=False, incremental=False):
         logging.info('Start clustering keys')
         keys_texts, keys_embs = self.files.load_keys()
         if keys_texts is None or\
@@ -124,46 +271,115 @@ class RunCluster():
             return
         logging.info(f'\tKeys embeddings shape: {keys_embs.shape}')
 
-        logging.info('\tNormalize and reduce dimensionality of keys embeddings...')
-        #keys_embs = cluster.normalize_l2(keys_embs[:, :Config.EMB_DIM_KEYS])
-        coords_2d = cluster.emb_2d_umap(keys_embs,
-                                        n_neighbors=Config.N_NEIGHBORS_KEYS,
-                                        min_dist=Config.MIN_DIST_KEYS)  
-        np.save(os.path.join(Config.OUT_DIR, 'keys_coords.npy'), coords_2d)
-        logging.info('\tNormalize and reduce dimensionality of keys embeddings...Done')
+        progress_data = self.progress_data('keys', keys_texts)
+        cluster_indices, progress = self.load_unfinished_summary('keys', progress_data) if with_llm_summary else (None, None)
+        if cluster_indices is not None:
+            # Descriptions reused from the previous run when the interrupted summarization started
+            labels_descriptions = progress['Reused']
+            n_clusters = cluster_indices.max()+1
+        else:
+            logging.info('\tNormalize and reduce dimensionality of keys embeddings...')
+            #keys_embs = cluster.normalize_l2(keys_embs[:, :Config.EMB_DIM_KEYS])
+            keys_embs = self.reduce('keys', keys_embs, Config.REDUCTION_KEYS)
+            keys_knn_index = self.knn_index('keys', keys_embs)
+            coords_2d = cluster.emb_2d_umap(keys_embs,
+                                            n_neighbors=Config.N_NEIGHBORS_KEYS,
+                                            min_dist=Config.MIN_DIST_KEYS,
+                                            knn_index=keys_knn_index)
+            np.save(os.path.join(Config.OUT_DIR, 'keys_coords.npy'), coords_2d)
+            logging.info('\tNormalize and reduce dimensionality of keys embeddings...Done')
+
+            logging.info('\tClustering keys embeddings...')
 
-        logging.info('\tClustering keys embeddings...')
+            cluster_indices = np.zeros(keys_embs.shape[0], dtype=int) - 1
+            labels_descriptions = []
+            previous = self.files.load_keys_clustering() if incremental else None
+            if previous is not None and \
+                (previous['meta'] is None or previous['meta'].get('Space') != self.embedding_spaces['keys']):
+                # REDUCTION_KEYS (method, parameters or the fitted reducer) changed since the previous run
+                logging.warning('\tPrevious keys clusters are in a different embedding space; re-clustering all keys')
+                previous = None
+            elif previous is not None and \
+                (previous['meta'].get('Clustering_id') != self.clusters_signature(previous['cluster_indices']) or \
+                    previous['meta'].get('N_clusters') != previous['centroids'].shape[0]):
+                # The files were not all written by the same run
+                logging.warning('\tPrevious keys clustering files are inconsistent; re-clustering all keys')
+                previous = None
+            if previous is not None:
+                # Keep the clusters of the previous run and assign new keys to them
+                logging.info('\tAssigning keys to previous clusters...')
+                previous_clusters = dict(zip(previous['members'], previous['cluster_indices']))
+                for i, t in enumerate(keys_texts):
+                    cluster_indices[i] = previous_clusters.get((t['PMC_ID'], t['Key']), -1)
+                new_indices = np.array([i for i, t in enumerate(keys_texts)
+                                        if (t['PMC_ID'], t['Key']) not in previous_clusters], dtype=int)
+                if len(new_indices) > 0:
+                    cluster_indices[new_indices] = cluster.assign_to_clusters(keys_embs[new_indices],
+                                                                              previous['centroids'],
+                                                                              similarity_threshold=Config.KEYS_INCREMENTAL_SIMILARITY)
+                n_previous_clusters = previous['centroids'].shape[0]
+                # Descriptions are reused by list position, so they must belong to these clusters
+                if previous['labels_descriptions'] is not None and \
+                    previous['meta'].get('Labels_clustering_id') == previous['meta'].get('Clustering_id') and \
+                        len(previous['labels_descriptions']) == n_previous_clusters:
+                    labels_descriptions = previous['labels_descriptions']
+                elif previous['labels_descriptions'] is not None:
+                    logging.warning('\tPrevious keys labels do not belong to the previous clusters; summarizing all clusters')
+                logging.info(f'\t\tNew keys: {len(new_indices)}, '
+                             f'assigned to previous clusters: {int((cluster_indices[new_indices] >= 0).sum())}')
+                logging.info('\tAssigning keys to previous clusters...Done')
+            else:
+                n_previous_clusters = 0
 
-        clusters_dict = cluster.run_matching_keys(keys_embs, keys_texts, self.llm,
-                                                  purity_threshold=Config.KEYS_PURITY_THRESHOLD,
-                                                  min_size=Config.KEYS_MIN_SIZE)
+            # Hierarchical purity search over the keys not assigned to any cluster
+            remaining_indices = np.where(cluster_indices == -1)[0]
+            clusters_dict = []
+            if len(remaining_indices) >= max(2, Config.KEYS_MIN_SIZE):
+                clusters_dict = cluster.run_matching_keys(keys_embs[remaining_indices],
+                                                          [keys_texts[i] for i in remaining_indices],
+                                                          self.llm,
+                                                          purity_threshold=Config.KEYS_PURITY_THRESHOLD,
+                                                          min_size=Config.KEYS_MIN_SIZE,
+                                                          n_workers=Config.KEYS_PURITY_WORKERS,
+                                                          linkage_backend=Config.KEYS_LINKAGE_BACKEND,
+                                                          linkage_n_neighbors=Config.KEYS_LINKAGE_N_NEIGHBORS,
+                                                          linkage_memory_limit=Config.KEYS_LINKAGE_MEMORY_LIMIT,
+                                                          auto_thresholds=Config.KEYS_AUTO_PURITY_THRESHOLDS,
+                                                          calibration_file=os.path.join(Config.OUT_DIR, 'keys_purity_calibration.json'),
+                                                          # The index covers all keys, so it is only usable without subsetting
+                                                          knn_index=keys_knn_index if len(remaining_indices) == len(keys_texts) else None)
 
-        cluster_indices = np.zeros(keys_embs.shape[0], dtype=int) - 1
-        for i, cl in enumerate(clusters_dict):
-            for idx in cl['Indices']:
-                cluster_indices[idx] = i
+            for i, cl in enumerate(clusters_dict):
+                for idx in cl['Indices']:
+                    cluster_indices[remaining_indices[idx]] = n_previous_clusters + i
+            n_clusters = n_previous_clusters + len(clusters_dict)
 
-        np.save(os.path.join(Config.OUT_DIR, 'keys_cluster_indices.npy'), cluster_indices)
-        logging.info(f'\t\tNumber of clusters: {cluster_indices.max()+1}')
-        logging.info('\tClustering keys embeddings...Done')
+            self.files.write_keys_clustering(cluster_indices,
+                                             cluster.compute_centroids(keys_embs, cluster_indices, n_clusters),
+                                             [(t['PMC_ID'], t['Key']) for t in keys_texts],
+                                             {'Space': self.embedding_spaces['keys'],
+                                              'Clustering_id': self.clusters_signature(cluster_indices),
+                                              'N_clusters': int(n_clusters)})
+            logging.info(f'\t\tNumber of clusters: {n_clusters}')
+            logging.info('\tClustering keys embeddings...Done')
 
         if with_llm_summary:
             logging.info('\tSummarizing clustering results...')
-            labels_descriptions = []
             keys_labels = ['Unlabelled'] * keys_embs.shape[0]
-            for cluster_id in range(cluster_indices.max()+1):
+            # Clusters labelled in the previous run keep their descriptions
+            def summarize(cluster_id):
                 keys_indices_cluster = np.where(cluster_indices == cluster_id)[0]
-                keys_texts_cluster =  clusters_dict[cluster_id]['Texts']
-                result = self.llm.summarize_keys(keys_texts_cluster)
-                result = json.loads(result)
-                for idx in keys_indices_cluster:
+                keys_texts_cluster = [cluster.render_key_text(keys_texts[i]) for i in keys_indices_cluster]
+                return json.loads(self.llm.summarize_keys(keys_texts_cluster))
+            cluster_ids = list(range(len(labels_descriptions), n_clusters))
+            labels_descriptions = labels_descriptions + self.summarize_clusters('keys', cluster_indices, cluster_ids, summarize, progress_data,
+                                                                                reused=labels_descriptions)
+            for cluster_id, result in enumerate(labels_descriptions):
+                for idx in np.where(cluster_indices == cluster_id)[0]:
                     keys_labels[idx] = result['Label']
-                labels_descriptions.append(result)
-                logging.info(f'\tCluster{cluster_id}: {result}')
             with open(os.path.join(Config.OUT_DIR, 'keys_labels.pkl'), 'wb') as f:
                 pickle.dump(keys_labels, f)
-            with open(os.path.join(Config.OUT_DIR, 'keys_labels_descriptions.json'), 'w') as f:
-                json.dump(labels_descriptions, f)
+            self.files.write_keys_labels_descriptions(labels_descriptions, self.clusters_signature(cluster_indices))
             logging.info('\tSummarizing clustering results...Done')
         else:
             keys_labels = ['Unlabelled'] * keys_embs.shape[0]
@@ -208,4 +424,4 @@ if __name__ == '__main__':
     elif sys.argv[1] == 'methods':
         runcluster.run_methods(with_llm_summary=True)
     elif sys.argv[1] == 'keys':
-        runcluster.run_keys(with_llm_summary=True)
+        runcluster.run_keys(with_llm_summary=True, incremental=Config.KEYS_INCREMENTAL)
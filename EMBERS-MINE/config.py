@@ -6,6 +6,11 @@ class DevelopmentConfig:
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
     MODEL_NAME = 'gpt-4-turbo'
     MAX_TOKENS = 120000
+    # Continuation of outputs truncated by the max output tokens
+    MAX_CONTINUATION_ROUNDS = 5
+    CONTINUATION_TAIL_TOKENS = 1000
+    # Stop the screening step once the decision has been generated
+    SCREENING_EARLY_EXIT = True
 
     PMC_DIR = './PMC_Dataset'
     RESULT_BASE_DIR = './result'
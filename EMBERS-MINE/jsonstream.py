@@ -0,0 +1,209 @@
+import json
+
+class JSONStream():
+    ###
+    # ストリーミングで届くJSON文字列を逐次走査し、
+    # 括弧の対応状態を保持して、途中で切れたJSONを補完するクラス
+    ###
+    def __init__(self):
+        self.text = ''
+        self.start = -1
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        # Last position where the text can be cut and closed to give valid JSON:
+        # (cut position, closing stack at that position)
+        self.safe_point = None
+        # End of the top-level value; nothing after it is scanned
+        self.end = None
+        # Incremented whenever a value may have been completed (',' or a closing bracket)
+        self.n_events = 0
+
+    def feed(self, chunk):
+        if self.end is not None:
+            # The top-level value is complete; ignore trailing text (e.g. ``` fences)
+            return
+        offset = len(self.text)
+        self.text += chunk
+        for n, c in enumerate(chunk):
+            i = offset + n
+            if self.start < 0:
+                # Skip anything before the JSON body (e.g. ```json fences)
+                if c in '{[':
+                    self.start = i
+                else:
+                    continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                continue
+            if c == '"':
+                self.in_string = True
+            elif c in '{[':
+                self.stack.append('}' if c == '{' else ']')
+                if self.safe_point is None:
+                    # Nested openers are not safe points, so a cut-off value is dropped as a whole
+                    self.safe_point = (i + 1, ''.join(self.stack))
+            elif c in '}]':
+                if self.stack:
+                    self.stack.pop()
+                if self.stack:
+                    # The top-level closer is not a safe point, so a complete but invalid body
+                    # can still fall back to its last completed inner value
+                    self.safe_point = (i + 1, ''.join(self.stack))
+                self.n_events += 1
+                if not self.stack:
+                    self.end = i + 1
+                    self.text = self.text[:self.end]
+                    break
+            elif c == ',':
+                # Cut after the comma, so that a rewound text is continued with the next value
+                self.safe_point = (i + 1, ''.join(self.stack))
+                self.n_events += 1
+
+    def is_started(self):
+        return self.start >= 0
+
+    def is_complete(self):
+        return self.end is not None
+
+    def body(self):
+        if self.start < 0:
+            return ''
+        return self.text[self.start:]
+
+    def context(self):
+        # Human readable nesting path, used to tell the model where it stopped
+        path = ['object' if s == '}' else 'array' for s in self.stack]
+        if self.in_string:
+            path.append('string')
+        return ' > '.join(path)
+
+    def repaired_prefix(self):
+        # Valid JSON of everything up to the last completed value, available while streaming
+        if self.safe_point is None:
+            return None
+        cut, stack = self.safe_point
+        prefix = self.text[self.start:cut]
+        if prefix.endswith(','):
+            prefix = prefix[:-1]
+        return prefix + ''.join(reversed(stack))
+
+    def rewind(self):
+        ###
+        # 最後に完結した値の直後まで巻き戻し、途中で切れた値を捨てる
+        # 続きの生成はこの位置から始めるので、切れたトークンや文字列の途中から再開しなくてよい
+        ###
+        if self.safe_point is None or self.end is not None:
+            return
+        cut, stack = self.safe_point
+        self.text = self.text[:cut]
+        self.stack = list(stack)
+        self.in_string = False
+        self.escape = False
+
+    def repair(self):
+        ###
+        # 途中で切れたJSONを閉じて、json.loads可能な文字列を返す
+        # 補完できない場合はNoneを返す
+        ###
+        if self.start < 0:
+            return None
+        body = self.body()
+        if self.is_complete():
+            try:
+                json.loads(body)
+                return body
+            except json.JSONDecodeError:
+                return self.validated_prefix()
+
+        # Optimistic repair: close the open string and all open brackets
+        candidate = body
+        if self.in_string:
+            if self.escape:
+                candidate = candidate[:-1]
+            candidate += '"'
+        candidate = candidate.rstrip()
+        if candidate.endswith(','):
+            candidate = candidate[:-1]
+        elif candidate.endswith(':'):
+            candidate += ' null'
+        candidate += ''.join(reversed(self.stack))
+        try:
+            json.loads(candidate)
+            return candidate
+        except json.JSONDecodeError:
+            pass
+
+        # Fall back to the last position where a complete value ended
+        return self.validated_prefix()
+
+    def validated_prefix(self):
+        # repaired_prefix() if it parses, otherwise None
+        candidate = self.repaired_prefix()
+        if candidate is None:
+            return None
+        try:
+            json.loads(candidate)
+            return candidate
+        except json.JSONDecodeError:
+            return None
+
+    def partial(self):
+        # Parsed value of the JSON received so far (None if not parsable yet)
+        repaired = self.repair()
+        if repaired is None:
+            return None
+        return json.loads(repaired)
+
+def strip_overlap(previous, continuation, min_overlap=20, max_overlap=500):
+    ###
+    # 続きの出力の冒頭で、前回の出力の末尾を繰り返した部分を取り除く
+    # min_overlap文字未満の重なりは、前回の出力の行頭から始まる場合(最後の行の繰り返し)のみ取り除く
+    ###
+    if continuation.startswith('```json'):
+        continuation = continuation[len('```json'):].lstrip()
+    elif continuation.startswith('```'):
+        continuation = continuation[len('```'):].lstrip()
+    for n in range(min(max_overlap, len(previous), len(continuation)), 0, -1):
+        overlap = continuation[:n]
+        if not overlap.strip() or not previous.endswith(overlap):
+            continue
+        before = previous[:len(previous) - n].rstrip(' \t')
+        if n >= min_overlap or before == '' or before.endswith('\n'):
+            return continuation[n:]
+    # The comma kept at the end of a rewound text, repeated on its own
+    if previous.rstrip().endswith(',') and continuation.lstrip().startswith(','):
+        return continuation.lstrip()[1:]
+    return continuation
+
+class ContinuationStream():
+    ###
+    # 続きの出力を元のJSONStreamに逐次流し込むクラス
+    # 冒頭でモデルが繰り返した部分を取り除くため、最初のmax_overlap文字だけバッファする
+    ###
+    def __init__(self, stream, max_overlap=500):
+        self.stream = stream
+        self.max_overlap = max_overlap
+        self.buffer = ''
+        self.flushed = False
+
+    def feed(self, chunk):
+        if self.flushed:
+            self.stream.feed(chunk)
+            return
+        self.buffer += chunk
+        if len(self.buffer) >= self.max_overlap:
+            self.flush()
+
+    def flush(self):
+        if not self.flushed:
+            self.flushed = True
+            self.stream.feed(strip_overlap(self.stream.text, self.buffer, max_overlap=self.max_overlap))
+
+    def is_complete(self):
+        return self.stream.is_complete()
@@ -2,6 +2,7 @@ import openai
 import tiktoken
 import json
 from config import Config
+from jsonstream import JSONStream, ContinuationStream
 
 class LLM():
     ###
@@ -49,9 +50,14 @@ class LLM():
             result_json = None
         return result_json
 
-    def generate_long_output(self,
-                             system_setting_prompt='',
-                             user_input=''):
+    def openai_wrapper_stream(self,
+                              system_setting_prompt='',
+                              user_input='',
+                              stop_conditions=[]):
+        ###
+        # openai_wrapperのストリーミング版
+        # stop_conditionsのいずれかが部分的にパースしたJSONに対してTrueを返した時点で生成を打ち切る
+        ###
         response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=[
@@ -59,33 +65,114 @@ class LLM():
                     {"role": "user", "content": user_input},
                 ],
                 temperature=0.1,
+                response_format={ "type": "json_object" },
                 seed=8888,
                 n=1,
                 stop=None,
+                stream=True,
         )
-        output = response.choices[0].message.content.strip()
-        if response.choices[0].finish_reason == 'length':
-            print('*****Output*****', output)
+        stream = JSONStream()
+        n_events = 0
+        for chunk in response:
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            stream.feed(delta)
+            if stream.is_complete():
+                # Nothing after the top-level value is needed
+                response.close()
+                break
+            if len(stop_conditions) == 0 or stream.n_events == n_events:
+                continue
+            # Check the conditions only when a value may have been completed
+            n_events = stream.n_events
+            partial = stream.partial()
+            if partial is not None and any(condition(partial) for condition in stop_conditions):
+                response.close()
+                break
+        result_json = stream.repair()
+        if result_json is None:
+            print('*****Failed to parse streamed JSON output*****', stream.text[-200:])
+        return result_json
+
+    def stream_completion(self,
+                          messages=[],
+                          stream=None):
+        # Stream a chat completion into a JSONStream and return the finish reason
+        # (the response is closed as soon as the top-level JSON value is complete)
+        response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=0.1,
+                seed=8888,
+                n=1,
+                stop=None,
+                stream=True,
+        )
+        finish_reason = None
+        for chunk in response:
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                stream.feed(delta)
+                if stream.is_complete():
+                    response.close()
+                    return 'stop'
+            if chunk.choices[0].finish_reason is not None:
+                finish_reason = chunk.choices[0].finish_reason
+        return finish_reason
+
+    def generate_long_output(self,
+                             system_setting_prompt='',
+                             user_input='',
+                             max_rounds=Config.MAX_CONTINUATION_ROUNDS):
+        messages = [
+            {"role": "system", "content": system_setting_prompt},
+            {"role": "user", "content": user_input},
+        ]
+        stream = JSONStream()
+        finish_reason = self.stream_completion(messages=messages, stream=stream)
+
+        n_round = 0
+        while finish_reason == 'length' and not stream.is_complete():
             # 出力が最大出力トークン数を超えた場合
-            updated_user_input = user_input + '\n\nYour output:\n' + output + '\nPlease go on with the rest of the JSON and complete the JSON output.'
-            print('*****Updated User Input*****', updated_user_input)
-            return self.generate_long_output(system_setting_prompt=system_setting_prompt,
-                                        user_input=updated_user_input)
-        else:
-            try:
-                result_json = response.choices[0].message.content.strip()
-                if result_json.startswith('```json'):
-                        result_json = result_json.replace('```json', '')
-                        result_json = result_json.replace('```', '')
-            except Exception as e:
-                print(e)
-                result_json = None
-            return result_json
+            n_round += 1
+            if n_round > max_rounds:
+                print(f'*****Continuation rounds exceeded ({max_rounds}); repairing partial JSON*****')
+                break
+            # Continue after the last completed value (the repaired prefix); the value that was
+            # cut off is dropped and generated again instead of resuming mid-token.
+            stream.rewind()
+            # Only the tail of the partial output is sent back as an assistant turn,
+            # so every round costs the prompt plus a fixed window instead of all prior output.
+            tail = self.tokenizer.decode(
+                self.tokenizer.encode(stream.text)[-Config.CONTINUATION_TAIL_TOKENS:]
+            )
+            continuation_messages = messages + [
+                {"role": "assistant", "content": tail},
+                {"role": "user", "content": 'Your output was cut off at the end of the message above '
+                                            f'(currently inside: {stream.context()}). '
+                                            'Continue the JSON from exactly the next character. '
+                                            'Do not repeat any text that was already written and do not add code fences.'},
+            ]
+            # The continuation is fed into the same stream as it arrives
+            continuation = ContinuationStream(stream)
+            finish_reason = self.stream_completion(messages=continuation_messages, stream=continuation)
+            continuation.flush()
+            print(f'*****Continuation round {n_round}: {len(stream.text)} chars*****')
+
+        result_json = stream.repair()
+        if result_json is None:
+            print('*****Failed to repair JSON output*****', stream.text[-200:])
+        return result_json
 
-    
     def determine_target_study_or_not(self,
                                       abstract_text='',
-                                      method_text=''):
+                                      method_text='',
+                                      early_exit=Config.SCREENING_EARLY_EXIT):
         system_setting_prompt = '''
 Analyze the abstract and methods section to determine if the paper describes an original research study that includes metagenomic or 16S rRNA gene amplicon analysis of newly collected human fecal samples. The study should not be a review, meta-analysis, tool development, or drug testing on cultured cells. Studies focusing on non-human subjects such as mice, rats, or primates should also be excluded. The study may include analysis of other human body sites (e.g., oral microbiome) or other omics data (e.g., metatranscriptomics, metabolomics), but should not be purely focused on non-gut microbiome or other omics.
 
@@ -111,6 +198,11 @@ Methods text:
             # truncate input text
             user_input = self.truncate(user_input, Config.MAX_TOKENS)
 
+        if early_exit:
+            # Stop generating as soon as the decision is known
+            return self.openai_wrapper_stream(system_setting_prompt=system_setting_prompt,
+                                              user_input=user_input,
+                                              stop_conditions=[lambda result: isinstance(result, dict) and result.get('decision') in ('yes', 'no')])
         return self.openai_wrapper(system_setting_prompt=system_setting_prompt,
                                    user_input=user_input)
 